@@ -1,23 +1,48 @@
-import chippy8.asm
-import chippy8.emulator
 import sys
 
 def print_usage():
     print('Usage:\n  chippy8 MODULE\n\nModules:\n' \
             '\t- asm: Assemble CHIP8\n' \
             '\t- disasm: Disassemble CHIP8\n' \
-            '\t- emulator: CHIP8 emulator.')
+            '\t- emulator: CHIP8 emulator.\n' \
+            '\t- batch: Run CHIP8 roms headless in parallel.\n' \
+            '\t- bench: Benchmark the emulator and assembler.\n' \
+            '\t- trace: Decode an execution trace.\n' \
+            '\t- fuzz: Fuzz the inputs of a CHIP8 rom.\n' \
+            '\t- serve: Run CHIP8 sessions for clients over a Unix socket.\n' \
+            '\t- client: View and play a server session.')
 
 def main():
     if len(sys.argv) < 2:
         print_usage()
         return 1
     if sys.argv[1] == 'asm':
+        import chippy8.asm
         return chippy8.asm.main(sys.argv[1:])
     elif sys.argv[1] == 'disasm':
+        import chippy8.asm
         return chippy8.asm.main(sys.argv[1:])
     elif sys.argv[1] == 'emulator':
+        import chippy8.emulator
         return chippy8.emulator.main(sys.argv[2:])
+    elif sys.argv[1] == 'batch':
+        import chippy8.batch
+        return chippy8.batch.main(sys.argv[2:])
+    elif sys.argv[1] == 'bench':
+        import chippy8.bench
+        return chippy8.bench.main(sys.argv[2:])
+    elif sys.argv[1] == 'trace':
+        import chippy8.trace
+        return chippy8.trace.main(sys.argv[2:])
+    elif sys.argv[1] == 'fuzz':
+        import chippy8.fuzz
+        return chippy8.fuzz.main(sys.argv[2:])
+    elif sys.argv[1] == 'serve':
+        import chippy8.server
+        return chippy8.server.serve_main(sys.argv[2:])
+    elif sys.argv[1] == 'client':
+        import chippy8.server
+        return chippy8.server.client_main(sys.argv[2:])
     print_usage()
 
 if __name__ == "__main__":
@@ -1,6 +1,12 @@
-import parse
 import argparse
+import collections
+import hashlib
+import itertools
+import mmap
+import os
 import re
+import struct
+import time
 
 
 class Instruction:
@@ -11,20 +17,6 @@ class Instruction:
         self.opcode_exp = opcode_exp
         self.asm_exp = asm_exp
 
-    # Returns the machine binary for the ASM input
-    def get_opcode(self, asm):
-        return int(self.opcode_exp.format(**parse.parse(self.asm_exp,
-                                                        asm).named), 16)
-
-    # Returns the human readable ASM string for the instruction
-    def get_asm(self, opcode):
-        return self.asm_exp.format(**parse.parse(self.opcode_exp,
-                                                 opcode).named)
-
-    def clean_asm_input(s):
-        s = s.split(';')[0]
-        return ' '.join(s.split()).upper().replace('0X', '0x')
-
 INSTRUCTIONS_TABLE = {
         0x00E0: Instruction('0x00E0', 'CLS'),
         0x00EE: Instruction('0x00EE', 'RET'),
@@ -71,20 +63,231 @@ INSTRUCTIONS_TABLE = {
 }
 
 
+DecodedInstruction = collections.namedtuple('DecodedInstruction',
+        ['opcode', 'mnemonic', 'operands', 'x', 'y', 'n', 'nn', 'nnn'])
+DecodedInstruction.asm = property(lambda self: self.mnemonic
+        + (' ' + ', '.join(self.operands) if self.operands else ''))
+
+
+# Splits an opcode template such as '0x8{a}{b}6' into the mask and value of
+# its fixed nibbles, and the nibble shift of each named field
+def compile_opcode_exp(opcode_exp):
+    mask = 0
+    value = 0
+    fields = {}
+    for digit in re.findall('{[a-z]}|[0-9A-F]', opcode_exp[2:]):
+        mask <<= 4
+        value <<= 4
+        if digit[0] == '{':
+            fields[digit[1]] = 0
+        else:
+            mask |= 0xF
+            value |= int(digit, 16)
+        for field in fields:
+            fields[field] += 4
+    return mask, value, dict((k, v - 4) for k, v in fields.items())
+
+
+# Returns the templates that can match an opcode, indexed by its most
+# significant nibble, in INSTRUCTIONS_TABLE order
+def build_decode_table():
+    table = [[] for _ in range(0x10)]
+    for instruction in INSTRUCTIONS_TABLE.values():
+        mask, value, fields = compile_opcode_exp(instruction.opcode_exp)
+        table[value >> 12].append((mask, value, fields, instruction))
+    return table
+
+
+DECODE_TABLE = build_decode_table()
+_DECODE_CACHE = {}
+
+
+# returns the asm for an opcode from the templates, or None if it is invalid
+def decode_template(opcode):
+    for mask, value, fields, instruction in DECODE_TABLE[opcode >> 12]:
+        if opcode & mask == value:
+            return instruction.asm_exp.format(**dict(
+                (k, '%X' % ((opcode >> shift) & 0xF))
+                for k, shift in fields.items()))
+    return None
+
+
+# returns the DecodedInstruction for an opcode, or None if it is invalid
+def decode(opcode):
+    decoded = _DECODE_CACHE.get(opcode, False)
+    if decoded is not False:
+        return decoded
+    table = opcode_table()
+    asm = table.asm(opcode) if table is not None \
+            else decode_template(opcode)
+    decoded = None
+    if asm is not None:
+        mnemonic, _, operands = asm.partition(' ')
+        decoded = DecodedInstruction(opcode, mnemonic,
+                tuple(operands.split(', ')) if operands else (),
+                (opcode & 0x0F00) >> 8, (opcode & 0x00F0) >> 4,
+                opcode & 0x000F, opcode & 0x00FF, opcode & 0x0FFF)
+    _DECODE_CACHE[opcode] = decoded
+    return decoded
+
+
+# Compiles an asm template such as 'LD V{a}, 0x{b}{c}' into a regular
+# expression matching a whole line, with one hex digit group per field
+def compile_asm_exp(asm_exp):
+    pattern = ''
+    fields = []
+    for literal, field in re.findall('([^{]*)(?:{([a-z])})?', asm_exp):
+        pattern += re.escape(literal)
+        if field:
+            pattern += '([0-9A-F])'
+            fields.append(field)
+    return re.compile(pattern + '$'), fields
+
+
+# Returns the encoders of each mnemonic, in INSTRUCTIONS_TABLE order, as
+# (line regex, opcode fixed bits, shift of each regex group). Only used when
+# the opcode table file is not available, so built on first use
+def build_encode_table():
+    table = {}
+    for instruction in INSTRUCTIONS_TABLE.values():
+        _, value, shifts = compile_opcode_exp(instruction.opcode_exp)
+        regex, fields = compile_asm_exp(instruction.asm_exp)
+        table.setdefault(instruction.asm_exp.split()[0], []).append(
+                (regex, value, [shifts[field] for field in fields]))
+    return table
+
+
+_ENCODE_TABLE = []
+
+
+def encode_table():
+    if not _ENCODE_TABLE:
+        _ENCODE_TABLE.append(build_encode_table())
+    return _ENCODE_TABLE[0]
+
+# Opcode table files: this header, the asm of every opcode (NUL padded, empty
+# if invalid), then count (asm, opcode) records of every valid asm line
+# sorted by asm, to be searched in place once memory mapped
+OPCODE_TABLE_MAGIC = b'C8OP'
+OPCODE_TABLE_VERSION = 1
+OPCODE_TABLE_HEADER = struct.Struct('>4sBI')
+OPCODE_TABLE_ASM = 16
+OPCODE_TABLE_RECORD = struct.Struct('>16sH')
+_OPCODE_TABLE = []
+
+
+# Full decode and encode tables, over the bytes of an opcode table file
+class OpcodeTable:
+    def __init__(self, data):
+        self.data = data
+        _, _, self.count = OPCODE_TABLE_HEADER.unpack_from(data)
+        self.records = OPCODE_TABLE_HEADER.size \
+                + OPCODE_TABLE_ASM * 0x10000
+
+    # returns the asm for an opcode, or None if it is invalid
+    def asm(self, opcode):
+        start = OPCODE_TABLE_HEADER.size + OPCODE_TABLE_ASM * opcode
+        asm = self.data[start:start + OPCODE_TABLE_ASM].rstrip(b'\0')
+        return asm.decode() if asm else None
+
+    # returns the opcode for an asm line, or None if it is invalid
+    def opcode(self, asm_line):
+        key = asm_line.encode()
+        if len(key) > OPCODE_TABLE_ASM:
+            return None
+        key = key.ljust(OPCODE_TABLE_ASM, b'\0')
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = self.records + middle * OPCODE_TABLE_RECORD.size
+            asm = self.data[start:start + OPCODE_TABLE_ASM]
+            if asm < key:
+                low = middle + 1
+            elif asm > key:
+                high = middle
+            else:
+                return OPCODE_TABLE_RECORD.unpack_from(self.data, start)[1]
+        return None
+
+
+# Returns the contents of an opcode table file, built from the templates
+def build_opcode_table():
+    asm = b''.join((decode_template(opcode) or '').encode()
+            .ljust(OPCODE_TABLE_ASM, b'\0') for opcode in range(0, 0x10000))
+    encoded = {}
+    for instruction in INSTRUCTIONS_TABLE.values():
+        _, value, shifts = compile_opcode_exp(instruction.opcode_exp)
+        names = sorted(shifts)
+        for digits in itertools.product(range(0, 0x10), repeat=len(names)):
+            line = instruction.asm_exp.format(**dict((name, '%X' % digit)
+                for name, digit in zip(names, digits)))
+            encoded.setdefault(line.encode(), value | sum(digit
+                << shifts[name] for name, digit in zip(names, digits)))
+    return OPCODE_TABLE_HEADER.pack(OPCODE_TABLE_MAGIC, OPCODE_TABLE_VERSION,
+            len(encoded)) + asm + b''.join(OPCODE_TABLE_RECORD.pack(line,
+                opcode) for line, opcode in sorted(encoded.items()))
+
+
+# Returns the path of the opcode table file, named after the templates so
+# that editing INSTRUCTIONS_TABLE makes a new one
+def opcode_table_path():
+    digest = hashlib.sha1(repr([(instruction.opcode_exp, instruction.asm_exp)
+        for instruction in INSTRUCTIONS_TABLE.values()]).encode())
+    cache = os.environ.get('XDG_CACHE_HOME') \
+            or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'chippy8', 'opcodes-%d-%s.bin'
+            % (OPCODE_TABLE_VERSION, digest.hexdigest()[:16]))
+
+
+# Returns the OpcodeTable memory mapped from the cache file, writing the file
+# on first use. Returns None if the file can not be written, the templates
+# being used instead
+def opcode_table():
+    if _OPCODE_TABLE:
+        return _OPCODE_TABLE[0]
+    path = opcode_table_path()
+    table = None
+    try:
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '%s.%d' % (path, os.getpid())
+            with open(tmp, 'wb') as fout:
+                fout.write(build_opcode_table())
+            os.replace(tmp, path)
+        with open(path, 'rb') as fin:
+            data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _ = OPCODE_TABLE_HEADER.unpack_from(data)
+        if magic == OPCODE_TABLE_MAGIC and version == OPCODE_TABLE_VERSION:
+            table = OpcodeTable(data)
+    except (OSError, ValueError, struct.error):
+        pass
+    _OPCODE_TABLE.append(table)
+    return table
+
+
 def preprocess(file_in):
+    with open(file_in) as fin:
+        return preprocess_lines(fin)
+
+
+# returns a source line without comment, uppercased with single spaces
+def normalize_line(line):
+    return ' '.join(line.split(';')[0].split()).upper().replace('0X', '0x')
+
+
+def preprocess_lines(lines, normalize=normalize_line):
     src = []
     labels = {}
     i = 0
-    with open(file_in) as fin:
-        for line in fin:
-            line = ' '.join(line.split(';')[0].split()).upper()\
-                    .replace('0X', '0x')
-            label = Instruction.LABEL_DECL_PAT.match(line)
-            if label:
-                labels[label.group()[:-1]] = 0x200 + i
-            elif len(line) > 0:
-                src.append(line)
-                i += 2
+    for line in lines:
+        line = normalize(line)
+        label = Instruction.LABEL_DECL_PAT.match(line)
+        if label:
+            labels[label.group()[:-1]] = 0x200 + i
+        elif len(line) > 0:
+            src.append(line)
+            i += 2
     return src, labels
 
 
@@ -98,26 +301,31 @@ def label_substitute(line, labels):
 
 # returns the opcode for an asm line
 def lookup_opcode(asm_line):
-    for i in INSTRUCTIONS_TABLE.values():
-        if parse.search(i.asm_exp, asm_line) \
-                and asm_line.split()[0] == i.asm_exp.split()[0] \
-                and len(asm_line.split()) == len(i.asm_exp.split()):
-            return i.get_opcode(asm_line)
+    table = opcode_table()
+    if table is not None:
+        return table.opcode(asm_line)
+    for regex, value, shifts in encode_table().get(asm_line.split(' ', 1)[0],
+            ()):
+        match = regex.match(asm_line)
+        if match:
+            for digit, shift in zip(match.groups(), shifts):
+                value |= int(digit, 16) << shift
+            return value
     return None
 
 
 # returns the asm for an opcode
 def lookup_asm(opcode):
-    opcode_str = '0x{0:0{1}X}'.format(opcode, 4)
-    for i in INSTRUCTIONS_TABLE:
-        if (i & opcode) == opcode:
-            return INSTRUCTIONS_TABLE[i].get_asm(opcode_str)
-    return None
+    table = opcode_table()
+    if table is not None:
+        return table.asm(opcode)
+    decoded = decode(opcode)
+    return decoded.asm if decoded is not None else None
 
 
-def assemble(file_in, file_out, verbose=False):
-    barray = []
-    src_in, labels = preprocess(file_in)
+# returns the binary for preprocessed source lines
+def encode(src_in, labels, verbose=False):
+    barray = bytearray()
     for line in src_in:
         line = label_substitute(line, labels)
         b = lookup_opcode(line)
@@ -128,31 +336,374 @@ def assemble(file_in, file_out, verbose=False):
             barray.append((b & 0x00FF))
         else:
             print('Parse error: %s' % line)
+    return barray
+
+
+def assemble(file_in, file_out, verbose=False, optimize_code=False):
+    src_in, labels = preprocess(file_in)
+    if optimize_code:
+        src_in, labels, report = optimize(src_in, labels)
+        for line in report:
+            print(line)
+    barray = encode(src_in, labels, verbose)
     with open(file_out, 'wb') as fout:
-        fout.write(bytearray(barray))
+        fout.write(barray)
 
 
-def disassemble(file_in, file_out, program_start=0x200, verbose=False):
-    with open(file_in, 'rb') as fin:
-        with open(file_out, 'w') as fout:
-            barray = bytearray(fin.read())
-            k = 0
-            while k + 1 < len(barray):
-                opcode = (barray[k] << 8) + barray[k + 1]
-                asm_str = lookup_asm(opcode)
-                if asm_str is not None:
-                    if verbose:
-                        print('0x{:04X} ;\t{}'.format(opcode, asm_str))
-                    if k % 8 == 0:
-                        fout.write('%s ; %s\n' % (asm_str,
-                            hex(program_start + k)))
-                    else:
-                        fout.write('%s\n' % asm_str)
+SKIP_MNEMONICS = ('SE', 'SNE', 'SKP', 'SKNP')
+REGISTER_PAT = re.compile('^V[0-9A-F]$')
+
+
+def split_line(line):
+    mnemonic, _, operands = line.partition(' ')
+    return mnemonic, operands.split(', ') if operands else []
+
+
+# returns the register written by a line without any other effect (LD Vx, nn,
+# LD Vx, Vy, LD Vx, DT and ADD Vx, nn), or None
+def pure_write(line):
+    mnemonic, operands = split_line(line)
+    if len(operands) == 2 and REGISTER_PAT.match(operands[0]) \
+            and (mnemonic == 'LD' and operands[1] != '[I]'
+                    and operands[1] != 'K'
+                    or mnemonic == 'ADD' and operands[1].startswith('0x')):
+        return operands[0]
+    return None
+
+
+# returns the registers a line overwrites without reading them
+def overwritten(line):
+    mnemonic, operands = split_line(line)
+    if len(operands) != 2 or not REGISTER_PAT.match(operands[0]):
+        return ()
+    if mnemonic == 'LD' and operands[1] == '[I]':
+        return ['V%X' % i for i in range(0, int(operands[0][1], 16) + 1)]
+    if mnemonic in ('LD', 'RND') and operands[1] != operands[0]:
+        return [operands[0]]
+    return ()
+
+
+# returns True if a line refers to a program address by number rather than
+# by label, or jumps relative to V0: such code can not move
+def uses_absolute_address(line):
+    mnemonic, operands = split_line(line)
+    if mnemonic in ('JP', 'CALL', 'SYS'):
+        return len(operands) > 1 or not operands[-1].startswith('$')
+    return mnemonic == 'LD' and operands[0] == 'I' \
+            and operands[1].startswith('0x') and int(operands[1], 16) >= 0x200
+
+
+# Peephole optimization of preprocessed source lines: threads jumps and calls
+# to jumps, turns CALL followed by RET into JP, folds consecutive ADD Vx, nn
+# and removes stores overwritten by the next instruction. Only the lines
+# reached by the control flow from 0x200 are rewritten, and an instruction is
+# only removed when it does not follow a skip, nor carry a label. Nothing is
+# removed when the source uses absolute addresses.
+#
+# returns the optimized lines, their labels and a report of the rewrites
+def optimize(src_in, labels):
+    barray = bytearray()
+    for line in src_in:
+        b = lookup_opcode(label_substitute(line, labels))
+        if b is None:
+            return src_in, labels, ['Not optimized: parse error: %s' % line]
+        barray += bytes([b >> 8, b & 0xFF])
+    code = trace_code(barray)[0]
+    shrink = not any(uses_absolute_address(line) for line in src_in)
+    names = collections.defaultdict(list)
+    for name, address in labels.items():
+        names[(address - 0x200) // 2].append(name)
+    # [line, reached, labels, address], the labels past the last line
+    lines = [[line, 0x200 + 2 * i in code, names.pop(i, []), 0x200 + 2 * i]
+            for i, line in enumerate(src_in)]
+    end_labels = [name for index in names.values() for name in index]
+    report = []
+
+    def rewrite(i, count, line):
+        report.append('0x%03X: %s -> %s' % (lines[i][3],
+            '; '.join(entry[0] for entry in lines[i:i + count]),
+            line if line is not None else '(removed)'))
+
+    # Labelled lines are never removed
+    labelled = dict((name, entry) for entry in lines for name in entry[2])
+
+    def target(line):
+        return labelled.get(split_line(line)[1][-1][1:])
+
+    changed = True
+    while changed:
+        changed = False
+        i = 0
+        while i < len(lines):
+            line, reached, line_labels, _ = lines[i]
+            after_skip = i > 0 and split_line(lines[i - 1][0])[0] \
+                    in SKIP_MNEMONICS
+            following = lines[i + 1] if i + 1 < len(lines) else None
+            mnemonic, operands = split_line(line)
+            if not reached:
+                i += 1
+                continue
+            if mnemonic in ('JP', 'CALL') and len(operands) == 1:
+                seen = set()
+                jump = target(line)
+                while jump is not None and jump[1] \
+                        and split_line(jump[0])[0] == 'JP' \
+                        and len(split_line(jump[0])[1]) == 1 \
+                        and jump[3] not in seen:
+                    seen.add(jump[3])
+                    threaded = '%s %s' % (mnemonic, split_line(jump[0])[1][0])
+                    if threaded == line:
+                        break
+                    rewrite(i, 1, threaded)
+                    line = lines[i][0] = threaded
+                    changed = True
+                    jump = target(line)
+                mnemonic, operands = split_line(line)
+            if following is None or not following[1]:
+                i += 1
+                continue
+            if mnemonic == 'CALL' and following[0] == 'RET':
+                rewrite(i, 2, 'JP %s' % operands[0]
+                        + ('' if shrink and not following[2]
+                            and not after_skip else '; RET'))
+                lines[i][0] = 'JP %s' % operands[0]
+                if shrink and not following[2] and not after_skip:
+                    del lines[i + 1]
+                changed = True
+            elif shrink and not after_skip and not following[2] \
+                    and mnemonic == 'ADD' and pure_write(line) \
+                    and split_line(following[0])[0] == 'ADD' \
+                    and pure_write(following[0]) == operands[0]:
+                total = (int(operands[1], 16)
+                        + int(split_line(following[0])[1][1], 16)) & 0xFF
+                folded = 'ADD %s, 0x%02X' % (operands[0], total)
+                if total == 0 and not line_labels:
+                    rewrite(i, 2, None)
+                    del lines[i:i + 2]
                 else:
-                    fout.write(';%s: invalid instruction (@%s)\n'
-                            % (hex(opcode), hex(program_start + k)))
-                    print('Parse error: %s' % hex(opcode))
-                k += 2
+                    rewrite(i, 2, folded)
+                    lines[i][0] = folded
+                    del lines[i + 1]
+                changed = True
+                continue
+            elif shrink and not after_skip and not line_labels \
+                    and pure_write(line) in overwritten(following[0]):
+                rewrite(i, 1, None)
+                del lines[i]
+                changed = True
+                continue
+            i += 1
+
+    saved = len(src_in) - len(lines)
+    report.append('%d instructions saved (%d bytes)' % (saved, 2 * saved))
+    if not shrink:
+        report.append('Code not shrunk: the source uses absolute addresses')
+    labels = {}
+    for i, entry in enumerate(lines):
+        for name in entry[2]:
+            labels[name] = 0x200 + 2 * i
+    for name in end_labels:
+        labels[name] = 0x200 + 2 * len(lines)
+    return [entry[0] for entry in lines], labels, report
+
+
+# Assembles successive versions of a source, keeping the normalized form of
+# each raw line and the opcode of each label substituted line of the last
+# version. Unchanged lines are not parsed again, and a line referring to a
+# label is only encoded again when the label moved
+class IncrementalAssembler:
+    def __init__(self):
+        self.lines = {}
+        self.opcodes = {}
+        self.encoded = 0
+
+    def normalize(self, line):
+        normalized = self.lines.get(line)
+        if normalized is None:
+            normalized = self.lines[line] = normalize_line(line)
+        return normalized
+
+    # returns the binary for the source lines
+    def assemble_lines(self, lines):
+        src_in, labels = preprocess_lines(lines, self.normalize)
+        self.lines = dict((line, self.lines[line]) for line in lines)
+        opcodes = {}
+        self.encoded = 0
+        barray = bytearray()
+        for line in src_in:
+            if '$' in line:
+                line = label_substitute(line, labels)
+            b = self.opcodes.get(line)
+            if b is None:
+                b = lookup_opcode(line)
+                self.encoded += 1
+                if b is None:
+                    print('Parse error: %s' % line)
+                    continue
+            opcodes[line] = b
+            barray.append((b & 0xFF00) >> 8)
+            barray.append((b & 0x00FF))
+        self.opcodes = opcodes
+        return barray
+
+
+# Assembles file_in into file_out whenever file_in is modified, polling its
+# modification time every interval seconds. file_out is only written when
+# the binary changed, and replaced at once so that a reading emulator never
+# sees a partial file
+def watch(file_in, file_out, interval=0.5):
+    assembler = IncrementalAssembler()
+    mtime = None
+    barray = None
+    while True:
+        # Editors saving by rename, or by deleting and writing the file, may
+        # leave it missing for a moment: it is read again on the next poll
+        lines = None
+        try:
+            stat = os.stat(file_in)
+            if stat.st_mtime_ns != mtime:
+                with open(file_in) as fin:
+                    lines = fin.read().splitlines()
+                mtime = stat.st_mtime_ns
+        except OSError:
+            pass
+        if lines is not None:
+            # A label still being typed is undefined: the pass is reported
+            # and the previous binary kept until the source is saved again
+            try:
+                output = assembler.assemble_lines(lines)
+            except KeyError as e:
+                print('Parse error: undefined label $%s' % e.args[0])
+                output = barray
+            if output != barray:
+                barray = output
+                with open(file_out + '.tmp', 'wb') as fout:
+                    fout.write(barray)
+                os.replace(file_out + '.tmp', file_out)
+                print('%s: %d bytes, %d lines encoded' % (file_out,
+                    len(barray), assembler.encoded))
+        time.sleep(interval)
+
+
+# yields the asm lines of a binary, decoding every word in order
+def disassemble_lines(barray, program_start=0x200, verbose=False):
+    k = 0
+    while k + 1 < len(barray):
+        opcode = (barray[k] << 8) + barray[k + 1]
+        asm_str = lookup_asm(opcode)
+        if asm_str is not None:
+            if verbose:
+                print('0x{:04X} ;\t{}'.format(opcode, asm_str))
+            if k % 8 == 0:
+                yield '%s ; %s\n' % (asm_str, hex(program_start + k))
+            else:
+                yield '%s\n' % asm_str
+        else:
+            yield ';%s: invalid instruction (@%s)\n' % (hex(opcode),
+                    hex(program_start + k))
+            print('Parse error: %s' % hex(opcode))
+        k += 2
+
+
+# Returns the addresses of the instructions reachable from program_start,
+# following jumps, calls, skips and returns, and the addresses referred to by
+# JP, CALL, JP V0 and LD I. Paths stop at RET, at invalid opcodes and at the
+# end of the binary
+def trace_code(barray, program_start=0x200):
+    end = program_start + len(barray) - 1
+    code = set()
+    targets = set()
+    pending = [program_start]
+    while pending:
+        address = pending.pop()
+        while program_start <= address < end and address not in code:
+            k = address - program_start
+            decoded = decode(barray[k] << 8 | barray[k + 1])
+            if decoded is None:
+                break
+            code.add(address)
+            kind = decoded.opcode >> 12
+            if decoded.opcode == 0x00EE:
+                break
+            elif kind in (0x1, 0x2, 0xA, 0xB):
+                targets.add(decoded.nnn)
+                if kind == 0x1:
+                    address = decoded.nnn
+                    continue
+                elif kind != 0xA:
+                    pending.append(decoded.nnn)
+                if kind == 0xB:
+                    break
+            elif kind in (0x3, 0x4, 0x5, 0x9, 0xE):
+                pending.append(address + 4)
+            address += 2
+    return code, targets
+
+
+# yields the asm lines of a binary, separating the code reachable from
+# program_start from data. Jump, call and load targets are labelled (L2A4:)
+# and referred to by label, data words are written as by disassemble_lines
+def disassemble_flow(barray, program_start=0x200):
+    code, targets = trace_code(barray, program_start)
+    end = program_start + len(barray) - 1
+    labels = set(target for target in targets
+            if program_start <= target < end
+            and (target - program_start) % 2 == 0)
+    k = 0
+    while k + 1 < len(barray):
+        address = program_start + k
+        opcode = (barray[k] << 8) + barray[k + 1]
+        if address in labels:
+            yield 'L%03X:\n' % address
+        if address in code:
+            decoded = decode(opcode)
+            asm_str = decoded.asm
+            if decoded.opcode >> 12 in (0x1, 0x2, 0xA, 0xB) \
+                    and decoded.nnn in labels:
+                asm_str = ' '.join([decoded.mnemonic, ', '.join(
+                    decoded.operands[:-1] + ('$L%03X' % decoded.nnn,))])
+            if k % 8 == 0:
+                yield '%s ; %s\n' % (asm_str, hex(address))
+            else:
+                yield '%s\n' % asm_str
+        else:
+            asm_str = lookup_asm(opcode)
+            if asm_str is not None:
+                yield '%s ; data %s\n' % (asm_str, hex(address))
+            else:
+                yield ';%s: invalid instruction (@%s)\n' % (hex(opcode),
+                        hex(address))
+        k += 2
+
+
+def disassemble(file_in, file_out, program_start=0x200, verbose=False,
+        flow=False):
+    with open(file_in, 'rb') as fin:
+        barray = bytearray(fin.read())
+    with open(file_out, 'w') as fout:
+        if flow:
+            fout.writelines(disassemble_flow(barray, program_start))
+        else:
+            fout.writelines(disassemble_lines(barray, program_start,
+                verbose))
+
+
+def disassemble_job(job):
+    disassemble(*job)
+    return job[1]
+
+
+# Disassembles each file of dir_in into dir_out/NAME.asm, over jobs processes
+def disassemble_dir(dir_in, dir_out, jobs, program_start=0x200, flow=False):
+    import multiprocessing
+    os.makedirs(dir_out, exist_ok=True)
+    work = [(os.path.join(dir_in, name),
+        os.path.join(dir_out, os.path.splitext(name)[0] + '.asm'),
+        program_start, False, flow) for name in sorted(os.listdir(dir_in))
+        if os.path.isfile(os.path.join(dir_in, name))]
+    with multiprocessing.Pool(jobs) as pool:
+        for file_out in pool.imap_unordered(disassemble_job, work):
+            print(file_out)
 
 
 def main(argv):
@@ -165,17 +716,40 @@ def main(argv):
         argp.add_argument("output", help="Output file")
         argp.add_argument("-v", "--verbose", default=False,
                 action="store_true", help="Enable verbose mode")
+        argp.add_argument("-w", "--watch", default=False,
+                action="store_true", help="Assemble again whenever the input "
+                "file changes, until interrupted")
+        argp.add_argument("-O", "--optimize", default=False,
+                action="store_true", help="Apply peephole optimizations, and "
+                "print the rewrites")
         args = argp.parse_args(argv)
-        assemble(args.input, args.output, args.verbose)
+        if args.watch:
+            try:
+                watch(args.input, args.output)
+            except KeyboardInterrupt:
+                pass
+        else:
+            assemble(args.input, args.output, args.verbose, args.optimize)
     else:
         argp = argparse.ArgumentParser(description='Chip8 Disassembler',
                 prog='chippy8 disasm')
-        argp.add_argument("input", help="Input file")
-        argp.add_argument("output", help="Output file")
+        argp.add_argument("input", help="Input file, or directory with -j")
+        argp.add_argument("output", help="Output file, or directory with -j")
         argp.add_argument("-p", "--program_start", default='0x200',
                 help="Set customer program start address (default 0x200).")
         argp.add_argument("-v", "--verbose", default=False,
                 action="store_true", help="Enable verbose mode")
+        argp.add_argument("-f", "--flow", default=False,
+                action="store_true", help="Follow the control flow from the "
+                "program start to separate code from data, and label jump "
+                "targets")
+        argp.add_argument("-j", "--jobs", type=int, default=None,
+                help="Disassemble every file of the input directory into the "
+                "output directory, over JOBS processes")
         args = argp.parse_args(argv)
-        disassemble(args.input, args.output, int(args.program_start, 16),
-                args.verbose)
+        if args.jobs:
+            disassemble_dir(args.input, args.output, args.jobs,
+                    int(args.program_start, 16), args.flow)
+        else:
+            disassemble(args.input, args.output, int(args.program_start, 16),
+                    args.verbose, args.flow)
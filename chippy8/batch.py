@@ -0,0 +1,114 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import chippy8.frames as frames
+from chippy8.emulator import CPU, HeadlessUI, ScriptedUI
+from chippy8.inputs import load_script
+
+
+# Returns the JSON serializable final state of a headless run
+def run_result(cpu):
+    return {
+        'cycles': cpu.cycles,
+        'frames': cpu.frames,
+        'PC': cpu.PC,
+        'I': cpu.I,
+        'DT': cpu.DT,
+        'ST': cpu.ST,
+        'V': list(cpu.V),
+        'stack': cpu.stack,
+        'framebuffer': hashlib.sha1(cpu.get_framebuffer()).hexdigest(),
+    }
+
+
+# Runs one (rom, seed, input script) job headless, and returns its result.
+# Errors raised by the rom are reported in the result
+def run_job(job):
+    rom, seed, inputs, options = job
+    ui = ScriptedUI(load_script(inputs)) if inputs else HeadlessUI()
+    cpu = CPU(ui, ips=options['ips'], throttle=False, seed=seed)
+    result = {'rom': rom, 'seed': seed, 'inputs': inputs}
+    if options['frames']:
+        result['frames_path'] = frames_path(job)
+        cpu.frame_sink = frames.open_sink(result['frames_path'],
+                options['frames_format'], cpu.frequency,
+                options['frames_scale'])
+    try:
+        cpu.load_rom(rom)
+        cpu.run(max_cycles=options['max_cycles'],
+                max_frames=options['max_frames'])
+        result['error'] = None
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    if cpu.frame_sink is not None:
+        cpu.frame_sink.close(cpu.frames)
+    result.update(run_result(cpu))
+    return result
+
+
+# Returns the frames output path of a job: ROM-SEED[-INPUTS][.FORMAT] in the
+# frames directory
+def frames_path(job):
+    rom, seed, inputs, options = job
+    name = '%s-%d' % (os.path.splitext(os.path.basename(rom))[0], seed)
+    if inputs:
+        name += '-' + os.path.splitext(os.path.basename(inputs))[0]
+    if options['frames_format'] != 'png':
+        name += '.' + options['frames_format']
+    return os.path.join(options['frames'], name)
+
+
+def list_roms(path):
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+            if os.path.isfile(os.path.join(path, name)))
+
+
+def main(argv):
+    argp = argparse.ArgumentParser(description='Chip8 batch runner',
+            prog='chippy8 batch')
+    argp.add_argument("roms", help="Rom file, or directory of rom files")
+    argp.add_argument("-s", "--seeds", type=int, default=1,
+            help="Run each rom with random seeds 0 to SEEDS - 1 (default 1)")
+    argp.add_argument("-n", "--inputs", nargs='+', default=[None],
+            help="Input script files, each rom is run once per script")
+    argp.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+            help="Number of worker processes (default: number of cores)")
+    argp.add_argument("-i", "--ips", type=int, default=700,
+            help="Set instructions executed per second of emulated time "
+            "(default 700)")
+    argp.add_argument("--max-cycles", type=int, default=None,
+            help="Stop each run after executing this many instructions")
+    argp.add_argument("--max-frames", type=int, default=None,
+            help="Stop each run after this many frames")
+    argp.add_argument("--frames", default=None,
+            help="Write the displayed frames of each run to this directory")
+    argp.add_argument("--frames-format", choices=frames.FORMATS,
+            default='gif', help="Format of the frames (default gif)")
+    argp.add_argument("--frames-scale", type=int, default=4,
+            help="Size in image pixels of a screen pixel (default 4)")
+    args = argp.parse_args(argv)
+    if args.max_cycles is None and args.max_frames is None:
+        argp.error('--max-cycles or --max-frames is required')
+    if args.frames:
+        os.makedirs(args.frames, exist_ok=True)
+
+    options = {'ips': args.ips, 'max_cycles': args.max_cycles,
+            'max_frames': args.max_frames, 'frames': args.frames,
+            'frames_format': args.frames_format,
+            'frames_scale': args.frames_scale}
+    jobs = [(rom, seed, inputs, options) for rom, seed, inputs
+            in itertools.product(list_roms(args.roms), range(args.seeds),
+                args.inputs)]
+    failed = 0
+    with multiprocessing.Pool(args.jobs) as pool:
+        for result in pool.imap_unordered(run_job, jobs):
+            failed += result['error'] is not None
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+    return 1 if failed else 0
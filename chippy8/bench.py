@@ -0,0 +1,208 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import time
+import chippy8.asm as asm
+from chippy8.emulator import CPU
+
+# Instructions per second used for the CPU workloads: frames are run back to
+# back, so this only sets how many instructions run between two frames
+BENCH_IPS = 60000
+
+ALU_SOURCE = '''
+LD V0, 0x01
+LD V1, 0x03
+loop:
+ADD V0, V1
+SUB V2, V0
+OR V3, V2
+AND V4, V3
+XOR V5, V4
+SHR V6, V5
+SHL V7, V6
+SUBN V8, V7
+LD V9, V8
+ADD V1, 0x01
+JP $loop
+'''
+
+SPRITE_SOURCE = '''
+LD I, 0x300
+loop:
+DRW V0, V1, 0xF
+ADD V0, 0x03
+ADD V1, 0x05
+DRW V1, V0, 0x8
+JP $loop
+'''
+
+MEMORY_SOURCE = '''
+LD I, 0x400
+loop:
+LD [I], VF
+LD VF, [I]
+LD [I], V7
+LD V7, [I]
+ADD V0, 0x01
+JP $loop
+'''
+
+CALL_SOURCE = '''
+loop:
+CALL $first
+JP $loop
+first:
+CALL $second
+RET
+second:
+CALL $third
+RET
+third:
+RET
+'''
+
+
+def assemble_source(source):
+    return asm.encode(*asm.preprocess_lines(source.splitlines()))
+
+
+# Returns a random source of count valid instruction lines
+def generate_source(count, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    while len(lines) < count:
+        line = asm.lookup_asm(rng.randrange(0x10000))
+        if line is not None:
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+# Each workload returns a function running one repetition, which returns the
+# number of operations and frames it executed
+def cpu_workload(source, frames):
+    program = assemble_source(source)
+
+    def run():
+        cpu = CPU(ips=BENCH_IPS, throttle=False, seed=0)
+        cpu.load_program(program)
+        cpu.run(max_frames=frames)
+        return cpu.cycles, cpu.frames
+    return run
+
+
+def asm_workload(count):
+    source = generate_source(count).splitlines()
+
+    def run():
+        asm.encode(*asm.preprocess_lines(source))
+        return count, 0
+    return run
+
+
+def disasm_workload(count):
+    program = assemble_source(generate_source(count))
+
+    def run():
+        for _ in asm.disassemble_lines(program):
+            pass
+        return len(program) // 2, 0
+    return run
+
+
+WORKLOADS = {
+    'alu': lambda: cpu_workload(ALU_SOURCE, 300),
+    'sprite': lambda: cpu_workload(SPRITE_SOURCE, 100),
+    'memory': lambda: cpu_workload(MEMORY_SOURCE, 300),
+    'call': lambda: cpu_workload(CALL_SOURCE, 300),
+    'asm': lambda: asm_workload(5000),
+    'disasm': lambda: disasm_workload(20000),
+}
+
+
+def measure(run, warmup, repeat):
+    for _ in range(warmup):
+        run()
+    rates = []
+    fps = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ops, frames = run()
+        elapsed = time.perf_counter() - start
+        rates.append(ops / elapsed)
+        fps.append(frames / elapsed)
+    mean = statistics.mean(rates)
+    return {
+        'ops_per_sec': mean,
+        'stdev': statistics.stdev(rates) if repeat > 1 else 0.0,
+        'min': min(rates),
+        'max': max(rates),
+        'us_per_op': 10 ** 6 / mean,
+        'fps': statistics.mean(fps),
+        'repeat': repeat,
+    }
+
+
+# Returns the names of the workloads slower than baseline by more than
+# threshold (relative)
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['ops_per_sec'] / baseline[name]['ops_per_sec']
+        result['baseline_ratio'] = ratio
+        if ratio < 1 - threshold:
+            regressions.append(name)
+    return regressions
+
+
+def print_results(results, regressions):
+    print('%-8s %14s %10s %10s %8s %8s' % ('workload', 'ops/s', 'us/op',
+        'frames/s', 'stdev', 'vs base'))
+    for name, result in results.items():
+        ratio = result.get('baseline_ratio')
+        print('%-8s %14.0f %10.3f %10.1f %7.1f%% %8s%s' % (name,
+            result['ops_per_sec'], result['us_per_op'], result['fps'],
+            100 * result['stdev'] / result['ops_per_sec'],
+            '%.2fx' % ratio if ratio is not None else '-',
+            ' REGRESSION' if name in regressions else ''))
+
+
+def main(argv):
+    argp = argparse.ArgumentParser(description='Chip8 benchmarks',
+            prog='chippy8 bench')
+    argp.add_argument("workloads", nargs='*', default=list(WORKLOADS),
+            help="Workloads to run among %s (default: all)"
+            % ', '.join(WORKLOADS))
+    argp.add_argument("-w", "--warmup", type=int, default=1,
+            help="Warmup runs of each workload (default 1)")
+    argp.add_argument("-r", "--repeat", type=int, default=5,
+            help="Measured runs of each workload (default 5)")
+    argp.add_argument("-o", "--output", default=None,
+            help="Save the results as JSON to this file")
+    argp.add_argument("-b", "--baseline", default=None,
+            help="Compare against the results saved in this JSON file")
+    argp.add_argument("-t", "--threshold", type=float, default=0.1,
+            help="Slowdown against the baseline reported as a regression "
+            "(default 0.1, 10%%)")
+    args = argp.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            argp.error('Unknown workload: %s' % name)
+
+    results = {}
+    for name in args.workloads:
+        results[name] = measure(WORKLOADS[name](), args.warmup, args.repeat)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as fin:
+            regressions = compare(results, json.load(fin)['results'],
+                    args.threshold)
+    print_results(results, regressions)
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump({'python': platform.python_version(),
+                'results': results}, fout, indent=2)
+    return 1 if regressions else 0
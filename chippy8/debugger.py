@@ -0,0 +1,194 @@
+import operator
+import re
+import time
+import chippy8.asm as asm
+
+COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '>': operator.gt,
+}
+
+CONDITION_PAT = re.compile('^(V[0-9A-F]|I|PC|DT|ST|\\[[0-9A-FX]+\\])\\s*'
+        '(==|!=|<=|>=|<|>)\\s*([0-9A-FX]+)$')
+WRITE_PAT = re.compile('^([0-9A-FX]+)(?:\\s*-\\s*([0-9A-FX]+))?$')
+
+
+# Returns a function of the CPU evaluating a watchpoint condition such as
+# 'V3 == 0x10', 'I >= 300' or '[0x300] != 0', parsed once. Addresses and
+# values are hexadecimal, as for -B, the 0x prefix being optional
+def compile_condition(expression):
+    match = CONDITION_PAT.match(expression.upper())
+    if not match:
+        raise ValueError('Invalid watchpoint: %s' % expression)
+    left, comparison, right = match.groups()
+    compare = COMPARISONS[comparison]
+    value = int(right, 16)
+    if left[0] == 'V':
+        x = int(left[1], 16)
+        return lambda cpu: compare(cpu.V[x], value)
+    if left[0] == '[':
+        address = int(left[1:-1], 16) & 0xFFF
+        return lambda cpu: compare(cpu.memory[address], value)
+    return lambda cpu: compare(getattr(cpu, left), value)
+
+
+# Returns the [start, end[ range of a write watchpoint such as 'F00' or
+# '0xF00-0xFFF' (hexadecimal), or None if expression is not one
+def parse_write(expression):
+    match = WRITE_PAT.match(expression.upper())
+    if not match:
+        return None
+    start = int(match.group(1), 16)
+    end = int(match.group(2), 16) if match.group(2) else start
+    return start, end + 1
+
+
+# Stops the CPU at PC breakpoints, on memory writes to a watched range, or
+# when a watchpoint condition becomes true. Until then the CPU runs its
+# predecoded blocks (or single steps with conditions, which are checked after
+# each instruction), and the debug panels are refreshed refresh_rate times
+# per second.
+#
+# Once stopped, 'n' runs the next instruction and space resumes, as does
+# space while running
+class Debugger:
+    def __init__(self, cpu, breakpoints=(), watchpoints=(), paused=False,
+            refresh_rate=10):
+        self.cpu = cpu
+        self.breakpoints = bytearray(0x1000)
+        for address in breakpoints:
+            self.breakpoints[address & 0xFFF] = 1
+        self.conditions = []
+        self.writes = []
+        for expression in watchpoints:
+            write = parse_write(expression)
+            if write is not None:
+                self.writes.append(write)
+            else:
+                self.conditions.append((expression,
+                    compile_condition(expression)))
+        self.states = [False] * len(self.conditions)
+        self.paused = paused
+        # Reason of the last stop, set while running
+        self.hit = None
+        self.cache = None
+        self.refresh_period = 10 ** 9 // refresh_rate
+        self.next_refresh = 0
+
+    # Watches memory writes through the code cache invalidation, which the
+    # CPU calls on every write
+    def watch_writes(self):
+        cache = self.cpu.code_cache
+        if not self.writes or cache is self.cache:
+            return
+        self.cache = cache
+        invalidate = cache.invalidate
+
+        def watched(start, end):
+            for watch_start, watch_end in self.writes:
+                if start < watch_end and watch_start < end:
+                    self.hit = 'W %s' % hex(max(start, watch_start))
+            invalidate(start, end)
+        cache.invalidate = watched
+
+    def run(self, max_cycles):
+        cpu = self.cpu
+        self.watch_writes()
+        end = cpu.cycles + max_cycles
+        while cpu.cycles < end and not cpu.waiting:
+            if self.paused:
+                self.wait_input()
+            elif self.conditions:
+                self.run_steps(end)
+            else:
+                self.run_blocks(end)
+            if self.hit is not None:
+                self.paused = True
+                self.show(self.hit)
+                self.hit = None
+        self.refresh()
+
+    # As CPU.run_blocks, single stepping the blocks holding a breakpoint
+    def run_blocks(self, end):
+        cpu = self.cpu
+        cache = cpu.code_cache
+        blocks = cache.blocks
+        breakpoints = self.breakpoints
+        cpu.cycles_end = end
+        while cpu.cycles < end and not cpu.waiting:
+            pc = cpu.PC
+            if breakpoints[pc & 0xFFF]:
+                self.hit = 'B %s' % hex(pc)
+                return
+            block = blocks.get(pc) or cache.get(pc)
+            if cpu.cycles + block.length > end \
+                    or breakpoints.find(1, pc + 1, block.end) >= 0:
+                cpu.step()
+            else:
+                cpu.PC = block.end
+                ops = iter(block.ops)
+                try:
+                    for op in ops:
+                        op()
+                except Exception:
+                    block.fault(cpu, ops)
+                    raise
+                cpu.cycles += block.length
+            if self.hit is not None:
+                return
+
+    def run_steps(self, end):
+        cpu = self.cpu
+        breakpoints = self.breakpoints
+        while cpu.cycles < end and not cpu.waiting:
+            if breakpoints[cpu.PC & 0xFFF]:
+                self.hit = 'B %s' % hex(cpu.PC)
+                return
+            cpu.step()
+            for i, (expression, condition) in enumerate(self.conditions):
+                state = condition(cpu)
+                if state and not self.states[i]:
+                    self.hit = expression
+                self.states[i] = state
+            if self.hit is not None:
+                return
+
+    # Waits for 'n', running the next instruction, or space, resuming after
+    # running the next instruction regardless of its breakpoint. Input is read
+    # blocking, so that a paused debugger does not use the CPU
+    def wait_input(self):
+        ui = self.cpu.ui
+        while True:
+            key = ui.wait_key()
+            if key == ord('n'):
+                self.cpu.step()
+                self.show()
+                return
+            if key == ord(' '):
+                self.paused = False
+                self.cpu.step()
+                return
+
+    def show(self, message=None):
+        ui = self.cpu.ui
+        ui.debug_show_registers(self.cpu)
+        if message is not None:
+            ui.debug_str(message[:16])
+        else:
+            ui.debug_str(asm.lookup_asm(self.cpu.opcode)
+                    or hex(self.cpu.opcode))
+
+    # Refreshes the panels and checks for a pause request, at most
+    # refresh_rate times per second
+    def refresh(self):
+        now = time.perf_counter_ns()
+        if self.paused or now < self.next_refresh:
+            return
+        self.next_refresh = now + self.refresh_period
+        self.show()
+        if self.cpu.ui.get_key() == ord(' '):
+            self.paused = True
@@ -1,15 +1,51 @@
+import collections
 import random
-import curses
+import os
+import struct
 import sys
 import time
-import chippy8.asm as asm
+import chippy8.debugger as debugger
+import chippy8.engine as engine
+import chippy8.frames as frames
+import chippy8.inputs as inputs
+import chippy8.profiler as profiler
+import chippy8.trace as trace
 import argparse
 
+# Snapshot layout: this header, then V, keys, key_latch, the random number
+# generator state, memory and the stack entries
+SNAPSHOT_MAGIC = b'C8ST'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('>4sBHHBBBHIQQdBd')
+SNAPSHOT_RANDOM = struct.Struct('>625I')
+SNAPSHOT_MEMORY = SNAPSHOT_HEADER.size + 48 + SNAPSHOT_RANDOM.size
+
+
+# Returns a memoryview of the 4KB memory image stored in a snapshot
+def snapshot_memory(blob):
+    return memoryview(blob)[SNAPSHOT_MEMORY:SNAPSHOT_MEMORY + 4096]
+
+
 class UI:
     HEIGHT = 32
     WIDTH = 64
-
-    def __init__(self, stdscr, debug=False):
+    # Frames a key stays pressed after its last key press, longer than the
+    # usual keyboard autorepeat delays (250 to 600ms at 60Hz)
+    KEY_TIMEOUT = 40
+
+    # curses is only imported with a screen, for the other UIs to run
+    # without it
+    def __init__(self, stdscr, debug=False, refresh_rate=60,
+            key_timeout=KEY_TIMEOUT):
+        import curses
+        self.reverse = curses.A_REVERSE
+        self.invisible = curses.A_INVIS
+        self.key_timeout = key_timeout
+        self.key_timers = [0] * 16
+        self.key_queue = collections.deque(maxlen=16)
+        self.refresh_period = 1 / refresh_rate if refresh_rate else 0
+        self.next_refresh = 0
+        self.last_frame = None
         self.debug_count = 0
         self.debug_hist = ''
         self.stdscr = stdscr
@@ -26,29 +62,90 @@ class UI:
                                             UI.WIDTH * 2 + 2 + 16 + 2)
             self.registers.border()
 
-    def get_bit_from_bytes(self, bytes_arr, location):
-        byte_ptr = int(location / 8)
-        bit_pos = 7 - (location % 8)
-        return 0x1 & (bytes_arr[byte_ptr] >> bit_pos)
-
-
-    def get_pixel(self, x, y, frame):
-        return 0 if self.get_bit_from_bytes(frame, y * 64 + x) == 0 else 1
-
+    # Returns the next key press that is not a keypad key, or -1. Keypad keys
+    # read on the way are recorded for read_keys
+    def get_key(self):
+        if self.key_queue:
+            return self.key_queue.popleft()
+        key = self.stdscr.getch()
+        while key in CPU.KEY_MAP:
+            self.key_timers[CPU.KEY_MAP[key]] = self.key_timeout
+            key = self.stdscr.getch()
+        return key
+
+    # As get_key, waiting up to timeout milliseconds for such a key. The wait
+    # is bounded so that SIGINT is still handled
+    def wait_key(self, timeout=100):
+        self.stdscr.timeout(timeout)
+        try:
+            return self.get_key()
+        finally:
+            self.stdscr.nodelay(True)
+
+    # Updates the keypad state from all pending key presses. Terminals do not
+    # report key releases: a key is held until no press of it has been seen
+    # for key_timeout calls, keyboard autorepeat keeping held keys pressed
+    def read_keys(self, keys):
+        key = self.stdscr.getch()
+        while key >= 0:
+            if key in CPU.KEY_MAP:
+                self.key_timers[CPU.KEY_MAP[key]] = self.key_timeout
+            else:
+                self.key_queue.append(key)
+            key = self.stdscr.getch()
+        for i in range(0, 0x10):
+            if self.key_timers[i] > 0:
+                self.key_timers[i] -= 1
+                keys[i] = 1
+            else:
+                keys[i] = 0
+
+    # Only the changed span of each row is sent to curses, as runs of same
+    # colored cells. Returns False when the frame is dropped because the next
+    # refresh is not due yet. Refreshes are scheduled on deadlines, with half
+    # a period of slack so that frames produced at the refresh rate are not
+    # dropped because of jitter
     def display_framebuffer(self, framebuffer):
+        now = time.monotonic()
+        if now < self.next_refresh:
+            return False
+        self.next_refresh = max(self.next_refresh,
+                now - self.refresh_period / 2) + self.refresh_period
+        frame = bytes(framebuffer)
+        last = self.last_frame
         for y in range(0, 32):
-            for x in range(0, 64):
-                self.stdscr.addstr(y + 1, x * 2 + 1, '  ', curses.A_REVERSE \
-                            if self.get_pixel(x, y, framebuffer) == 1 \
-                            else curses.A_INVIS)
+            row = frame[y * 8:y * 8 + 8]
+            first, end = 0, 8
+            if last is not None:
+                last_row = last[y * 8:y * 8 + 8]
+                if row == last_row:
+                    continue
+                while row[first] == last_row[first]:
+                    first += 1
+                while row[end - 1] == last_row[end - 1]:
+                    end -= 1
+            self.display_span(y, row, first * 8, end * 8)
+        self.last_frame = frame
         self.mainscreen.refresh()
+        return True
+
+    def display_span(self, y, row, start, end):
+        x = start
+        while x < end:
+            pixel = (row[x // 8] >> (7 - x % 8)) & 1
+            run = x + 1
+            while run < end and (row[run // 8] >> (7 - run % 8)) & 1 == pixel:
+                run += 1
+            self.stdscr.addstr(y + 1, x * 2 + 1, '  ' * (run - x),
+                    self.reverse if pixel else self.invisible)
+            x = run
 
     # Debug display
     def debug_show_registers(self, cpu):
         self.registers.addstr(1, 1, 'I = %s' % hex(cpu.I))
         self.registers.addstr(2, 1, 'PC = %s' % hex(cpu.PC))
         self.registers.addstr(3, 1, 'DT = %s' % hex(cpu.DT))
-        self.registers.addstr(4, 1, 'ST = %s' % hex(cpu.DT))
+        self.registers.addstr(4, 1, 'ST = %s' % hex(cpu.ST))
         for i in range(0, 0x10):
             self.registers.addstr(5 + i, 1, 'V[%s] = %s' % (hex(i),
                 hex(cpu.V[i])))
@@ -64,16 +161,99 @@ class UI:
             self.debug.border()
         self.debug_hist = s + ' ' * (16 - len(s))
         self.debug.addstr(1 + self.debug_count, 1 + 0, self.debug_hist,
-                curses.A_REVERSE)
+                self.reverse)
         self.debug.refresh()
         self.debug_count += 1
 
 
+# Display/input backend without any terminal: key state is injected with
+# press_key/release_key and the framebuffer is read from the CPU on demand
+class HeadlessUI:
+    def __init__(self):
+        self.keys = bytearray(16)
+
+    def press_key(self, key):
+        self.keys[key] = 1
+
+    def release_key(self, key):
+        self.keys[key] = 0
+
+    def get_key(self):
+        return -1
+
+    def wait_key(self):
+        return self.get_key()
+
+    def read_keys(self, keys):
+        keys[:] = self.keys
+
+    def display_framebuffer(self, framebuffer):
+        return True
+
+
+# Headless UI playing an input script back, one frame per read_keys call. All
+# keys are released once the script is over
+class ScriptedUI(HeadlessUI):
+    def __init__(self, script):
+        HeadlessUI.__init__(self)
+        self.runs = iter(script.runs)
+        self.run_frames = 0
+        self.mask = 0
+
+    def read_keys(self, keys):
+        while self.run_frames == 0:
+            # After the last run, run_frames never gets back to 0
+            self.run_frames, self.mask = next(self.runs, (-1, 0))
+        self.run_frames -= 1
+        for i in range(0, 0x10):
+            keys[i] = (self.mask >> i) & 1
+
+
+# Curses UI recording the keypad state of every frame into an input script
+class RecordingUI(UI):
+    def __init__(self, stdscr, script, **kwargs):
+        UI.__init__(self, stdscr, **kwargs)
+        self.script = script
+
+    def read_keys(self, keys):
+        UI.read_keys(self, keys)
+        mask = 0
+        for i in range(0, 0x10):
+            mask |= keys[i] << i
+        self.script.append(mask)
+
+
 class CPU:
-    def __init__(self, ui, debug=False, frequency=60):
+    KEY_ARRAY = ['x', # 0
+            '1', '2', '3', # 1, 2, 3
+            'q', 'w', 'e', # 4, 5, 6
+            'a', 's', 'd', # 7, 8, 9
+            'z', 'c', # a, b
+            '4', 'r', 'f', 'v' # c, d, e, f
+            ]
+    KEY_MAP = dict(zip(map(ord, KEY_ARRAY), range(0x10)))
+
+    # Frames behind schedule after which the frame pacing gives up catching up
+    MAX_FRAME_LAG = 5
+
+    def __init__(self, ui=None, debug=False, frequency=60, ips=700,
+            throttle=True, seed=None):
         self.debug = debug
+        self.seed = seed
         self.frequency = frequency
-        self.clock_rate = int((1 / self.frequency) * 1000)
+        self.ips = ips
+        self.throttle = throttle
+        self.frame_period = 10 ** 9 // self.frequency
+        self.debugger = debugger.Debugger(self) if debug else None
+        self.profiler = None
+        self.tracer = None
+        # Records the edges between the executed blocks, see fuzz.Coverage
+        self.coverage = None
+        # Receives the displayed frames, see frames.FrameSink
+        self.frame_sink = None
+        # Reload the rom when its file changes, see check_reload
+        self.reload = False
+        self.rom_path = None
 
         self.LOOKUP_TABLE_8 = {
             0x0000: self.t8_load_reg,
@@ -87,6 +267,11 @@ class CPU:
             0x000E: self.t8_shift_left,
         }
 
+        self.LOOKUP_TABLE_E = {
+            0x009E: self.te_skip_key,
+            0x00A1: self.te_skipn_key,
+        }
+
         self.LOOKUP_TABLE_F = {
             0x0007: self.tf_load_dt,
             0x000A: self.tf_wait_key,
@@ -125,17 +310,8 @@ class CPU:
             0xF000: self.lookup_f,
         }
 
-        self.KEY_ARRAY = ['x', # 0
-                '1', '2', '3', # 1, 2, 3
-                'q', 'w', 'e', # 4, 5, 6
-                'a', 's', 'd', # 7, 8, 9
-                'z', 'c', # a, b
-                '4', 'r', 'f', 'v' # c, d, e, f
-                ]
-
         self.reset()
-        self.ui = ui
-        self.last_tick = int(time.time() * 1000)
+        self.ui = ui if ui is not None else HeadlessUI()
 
     def lookup_0(self):
         if self.opcode == 0x00E0:
@@ -149,10 +325,7 @@ class CPU:
         return self.LOOKUP_TABLE_8[self.opcode & 0x000F]()
 
     def lookup_e(self):
-        if self.opcode & 0xEF9E:
-            return self.te_skip_key()
-        elif self.opcode & 0XEFA1:
-            return self.te_skipn_key()
+        return self.LOOKUP_TABLE_E[self.opcode & 0x00FF]()
 
     def lookup_f(self):
         return self.LOOKUP_TABLE_F[self.opcode & 0x00FF]()
@@ -161,6 +334,7 @@ class CPU:
     def t0_clear_screen(self):
         for i in range (0, 0x100):
             self.memory[0xF00 + i] = 0
+        self.code_cache.invalidate(0xF00, 0x1000)
 
     def t0_return_sub(self):
         self.PC = self.stack.pop()
@@ -279,69 +453,76 @@ class CPU:
     def tc_rand(self):
         x = (self.opcode & 0x0F00) >> 8
         k = self.opcode & 0x00FF
-        self.V[x] = random.randrange(0, 255) & k
+        self.V[x] = self.random.randrange(0, 255) & k
 
     # 0xD000
-    def get_memory_bit(self, location):
-        byte_ptr = int(location / 8)
-        bit_pos = 7 - (location % 8)
-        return 0x1 & (self.memory[byte_ptr] >> bit_pos)
-
-    def set_memory_bit(self, location, value):
-        byte_ptr = int(location / 8)
-        bit_pos = 7 - (location % 8)
-        self.memory[byte_ptr] = (self.memory[byte_ptr] \
-                & (0xff - (0x1 << bit_pos))) \
-                + (value << bit_pos)
-
+    # Each framebuffer row is 8 bytes, handled as one 64 bits word: sprite rows
+    # are rotated into place so that horizontal wraparound comes for free. Only
+    # the rows drawn are invalidated, in two ranges when they wrap around
     def td_draw(self):
-        x = self.V[(self.opcode & 0x0F00) >> 8]
-        y = self.V[(self.opcode & 0x00F0) >> 4]
+        x = self.V[(self.opcode & 0x0F00) >> 8] % 64
+        y = self.V[(self.opcode & 0x00F0) >> 4] % 32
         n = self.opcode & 0x000F
-        self.V[0xF] = 0
+        memory = self.memory
+        collision = 0
         for k in range(0, n):
-            y_comp = (y + k) % 32
-            for j in range(0, 8):
-                mem_bit = self.get_memory_bit((self.I + k) * 8 + j)
-                x_comp = (x + j) % 64
-                current_pixel = self.get_memory_bit(0xF00 * 8 + y_comp * 64 \
-                        + x_comp)
-                xored = 0x01 & (mem_bit ^ current_pixel)
-                self.set_memory_bit(0xF00 * 8 + y_comp * 64 + x_comp, xored)
-                if current_pixel > xored:
-                    self.V[0xF] = 1
+            sprite = memory[self.I + k] << 56
+            sprite = ((sprite >> x) | (sprite << (64 - x))) \
+                    & 0xFFFFFFFFFFFFFFFF
+            row = 0xF00 + ((y + k) % 32) * 8
+            current = int.from_bytes(memory[row:row + 8], 'big')
+            if current & sprite:
+                collision = 1
+            memory[row:row + 8] = (current ^ sprite).to_bytes(8, 'big')
+        self.V[0xF] = collision
+        if n:
+            self.code_cache.invalidate(0xF00 + y * 8,
+                    0xF00 + min(y + n, 32) * 8)
+            if y + n > 32:
+                self.code_cache.invalidate(0xF00, 0xF00 + (y + n - 32) * 8)
         self.draw_flag = True
 
     # 0xE000
-    def get_pressed_key(self):
-        key = self.ui.stdscr.getch()
-        return key if key >= 0 else 0
+    def poll_keys(self):
+        previous = bytes(self.keys)
+        self.ui.read_keys(self.keys)
+        for i in range(0, 0x10):
+            if not self.keys[i]:
+                self.key_latch[i] = 0
+            elif not previous[i]:
+                self.key_latch[i] = 1
+        self.keys_frame = self.frames
 
     def te_skip_key(self):
-        x = (self.opcode & 0x0F00) >> 8
-        key = self.get_pressed_key()
-        if chr(key) not in self.KEY_ARRAY \
-                or self.V[x] != self.KEY_ARRAY.index(chr(key)):
-                self.PC += 2
+        key = self.V[(self.opcode & 0x0F00) >> 8]
+        if key < 0x10 and self.keys[key]:
+            self.PC += 2
 
     def te_skipn_key(self):
-        x = (self.opcode & 0x0F00) >> 8
-        key = self.get_pressed_key()
-        if chr(key) in self.KEY_ARRAY \
-                and self.V[x] == self.KEY_ARRAY.index(chr(key)):
-                self.PC += 2
+        key = self.V[(self.opcode & 0x0F00) >> 8]
+        if key >= 0x10 or not self.keys[key]:
+            self.PC += 2
 
     # 0xF000
     def tf_load_dt(self):
         x = (self.opcode & 0x0F00) >> 8
         self.V[x] = self.DT
 
+    # Returns the first key pressed since its last press was returned, see
+    # key_latch: a key pressed before the wait and still held is returned
+    # right away, once, and must be released and pressed again to be
+    # returned again. Without such a key, rewinds PC and puts the CPU in a
+    # wait state: the current frame ends there, and the instruction is run
+    # again next frame
     def tf_wait_key(self):
         x = (self.opcode & 0x0F00) >> 8
-        key = self.get_pressed_key()
-        while chr(key) not in self.KEY_ARRAY:
-            key = self.get_pressed_key()
-        self.V[x] = self.KEY_ARRAY.index(chr(key))
+        key = self.key_latch.find(1)
+        if key >= 0:
+            self.key_latch[key] = 0
+            self.V[x] = key
+        else:
+            self.PC -= 2
+            self.waiting = True
 
     def tf_set_dt(self):
         x = (self.opcode & 0x0F00) >> 8
@@ -364,11 +545,13 @@ class CPU:
         self.memory[self.I] = int((self.V[x] % 1000) / 100)
         self.memory[self.I + 1] = int((self.V[x] % 100) / 10)
         self.memory[self.I + 2] = self.V[x] % 10
+        self.code_cache.invalidate(self.I, self.I + 3)
 
     def tf_write_mem(self):
         x = (self.opcode & 0x0F00) >> 8
         for i in range(x + 1):
             self.memory[self.I + i] = self.V[i]
+        self.code_cache.invalidate(self.I, self.I + x + 1)
 
     def tf_read_mem(self):
         x = (self.opcode & 0x0F00) >> 8
@@ -403,7 +586,9 @@ class CPU:
 
     def reset(self):
         self.running = True
+        self.random = random.Random(self.seed)
         self.memory = bytearray(4096)
+        self.code_cache = engine.BlockCache(self)
         self.V = bytearray(16)
         self.I = 0
         self.PC = 0x200
@@ -415,64 +600,306 @@ class CPU:
         self.stack = []
 
         self.keys = bytearray(16)
+        # Keys pressed since the last poll and not yet returned by FX0A
+        self.key_latch = bytearray(16)
+        self.keys_frame = None
 
         self.draw_flag = True
+        # Set by FX0A while no key is pressed
+        self.waiting = False
+        # Set when the UI dropped the last frame, to display it again later
+        self.frame_pending = False
+
+        self.cycles = 0
+        self.frames = 0
 
         self.load_characters()
 
         self.t0_clear_screen()
 
-        self.last_tick = int(time.time() * 1000)
+        # Instructions left to run in the current frame, and the fractional
+        # part of ips / frequency carried over to the next frames
+        self.frame_budget = 0
+        self.frame_credit = 0.0
+        self.add_frame_budget()
 
     def load_rom(self, program_file):
         with open(program_file, 'rb') as fin:
-            barray = bytearray(fin.read(4096 - 0x200))
-            i = 0
-            for b in barray:
-                self.memory[0x200 + i] = b
-                i += 1
-
-    def debug_handle_input(self, breakpoint):
-        if self.ui.stdscr.getch() == ord(' ') or breakpoint:
-            while self.ui.stdscr.getch() == ord(' '):
-                pass
-            while True:
-                key = self.ui.stdscr.getch()
-                if key == ord('n'):
-                    return True
-                if key  == ord(' '):
-                    return False
-
-    def run(self, breakpoint=False):
-        while True:
-            self.opcode = self.memory[self.PC & 0xFFF] << 8 \
-                    | self.memory[(self.PC + 1) & 0xFFF]
-            self.PC += 2
-
-            self.LOOKUP_TABLE[self.opcode & 0xF000]()
-
-            if self.debug:
-                breakpoint = self.debug_handle_input(breakpoint)
-                self.ui.debug_show_registers(self)
-                asm_str = asm.lookup_asm(self.opcode)
-                if asm_str:
-                    self.ui.debug_str(asm_str)
-                else:
-                    self.ui.debug_str(hex(self.opcode))
-
-            if self.draw_flag:
-                self.ui.display_framebuffer(self.memory[0xF00:])
-                self.draw_flag = False
-            now = int(time.time() * 1000)
-            if now  - self.last_tick > self.clock_rate:
-                self.tick()
-                self.last_tick = now
-
-def emulator_start(stdscr, rom_path, debug, frequency, breakpoint):
-    ui = UI(stdscr, debug=debug)
-    cpu = CPU(ui, debug=debug, frequency=frequency)
-    cpu.load_rom(rom_path)
-    cpu.run(breakpoint)
+            self.rom_path = program_file
+            self.rom_mtime = os.fstat(fin.fileno()).st_mtime_ns
+            self.load_program(fin.read(4096 - 0x200))
+
+    # Resets the machine and loads the rom again if its file was modified
+    # since it was loaded
+    def check_reload(self):
+        try:
+            mtime = os.stat(self.rom_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self.rom_mtime:
+            self.reset()
+            self.load_rom(self.rom_path)
+
+    def load_program(self, barray):
+        barray = barray[:4096 - 0x200]
+        self.memory[0x200:0x200 + len(barray)] = barray
+        self.code_cache.clear()
+
+    # Returns the machine state as a versioned binary blob
+    def snapshot(self):
+        blob = bytearray(SNAPSHOT_MEMORY + 4096 + 2 * len(self.stack))
+        _, words, gauss = self.random.getstate()
+        # gauss is None unless a gauss() value is pending, stored as NaN
+        SNAPSHOT_HEADER.pack_into(blob, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                self.PC, self.I, self.DT, self.ST, self.waiting,
+                len(self.stack), self.frame_budget, self.cycles, self.frames,
+                self.frame_credit, self.keys_frame == self.frames,
+                float('nan') if gauss is None else gauss)
+        view = memoryview(blob)
+        offset = SNAPSHOT_HEADER.size
+        view[offset:offset + 16] = self.V
+        view[offset + 16:offset + 32] = self.keys
+        view[offset + 32:offset + 48] = self.key_latch
+        SNAPSHOT_RANDOM.pack_into(blob, offset + 48, *words)
+        view[SNAPSHOT_MEMORY:SNAPSHOT_MEMORY + 4096] = self.memory
+        struct.pack_into('>%dH' % len(self.stack), blob,
+                SNAPSHOT_MEMORY + 4096, *self.stack)
+        return bytes(blob)
+
+    # Restores a state returned by snapshot. Memory, V and keys are copied in
+    # place straight from the blob's buffer
+    def restore(self, blob):
+        view = memoryview(blob)
+        if len(view) < SNAPSHOT_HEADER.size:
+            raise ValueError('Truncated snapshot')
+        magic, version, self.PC, self.I, self.DT, self.ST, waiting, depth, \
+                self.frame_budget, self.cycles, self.frames, \
+                self.frame_credit, keys_polled, gauss \
+                = SNAPSHOT_HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot format')
+        if len(view) < SNAPSHOT_MEMORY + 4096 + 2 * depth:
+            raise ValueError('Truncated snapshot')
+        self.waiting = bool(waiting)
+        self.keys_frame = self.frames if keys_polled else None
+        offset = SNAPSHOT_HEADER.size
+        self.V[:] = view[offset:offset + 16]
+        self.keys[:] = view[offset + 16:offset + 32]
+        self.key_latch[:] = view[offset + 32:offset + 48]
+        self.random.setstate((3, SNAPSHOT_RANDOM.unpack_from(view,
+            offset + 48), None if gauss != gauss else gauss))
+        self.memory[:] = snapshot_memory(view)
+        self.stack = list(struct.unpack_from('>%dH' % depth, view,
+            SNAPSHOT_MEMORY + 4096))
+        self.code_cache.clear()
+        self.draw_flag = True
+        self.frame_pending = False
+
+    def save_state(self, path):
+        with open(path, 'wb') as fout:
+            fout.write(self.snapshot())
+
+    def load_state(self, path):
+        with open(path, 'rb') as fin:
+            self.restore(fin.read())
+
+    def get_framebuffer(self):
+        return bytes(self.memory[0xF00:])
+
+    def step(self):
+        self.opcode = self.memory[self.PC & 0xFFF] << 8 \
+                | self.memory[(self.PC + 1) & 0xFFF]
+        self.PC += 2
+
+        self.LOOKUP_TABLE[self.opcode & 0xF000]()
+        self.cycles += 1
+
+    # Executes predecoded blocks until max_cycles instructions have run or the
+    # screen needs a redraw. Single steps through a block that would overrun
+    # max_cycles. cycles_end is the cycle count to stop at, for the fused
+    # timer waits that run up to it at once. An error leaves PC at the
+    # instruction that raised it
+    def run_blocks(self, max_cycles):
+        cache = self.code_cache
+        blocks = cache.blocks
+        end = self.cycles_end = self.cycles + max_cycles
+        while self.cycles < end and not self.waiting:
+            block = blocks.get(self.PC) or cache.get(self.PC)
+            if self.cycles + block.length > end:
+                self.step()
+                continue
+            self.PC = block.end
+            ops = iter(block.ops)
+            try:
+                for op in ops:
+                    op()
+            except Exception:
+                block.fault(self, ops)
+                raise
+            self.cycles += block.length
+
+    def add_frame_budget(self):
+        self.frame_credit += self.ips / self.frequency
+        budget = int(self.frame_credit)
+        self.frame_credit -= budget
+        self.frame_budget += budget
+
+    # Sleeps until the next frame is due. Frames are scheduled on absolute
+    # deadlines so that sleep inaccuracies do not accumulate, and the
+    # schedule restarts from now when running more than a few frames late
+    def wait_frame(self):
+        now = time.perf_counter_ns()
+        delay = self.next_frame - now
+        if delay > 0:
+            time.sleep(delay / 10 ** 9)
+        elif delay < -self.MAX_FRAME_LAG * self.frame_period:
+            self.next_frame = now
+        self.next_frame += self.frame_period
+
+    def end_frame(self):
+        self.tick()
+        self.frames += 1
+        self.add_frame_budget()
+        if self.draw_flag and self.frame_sink is not None:
+            self.frame_sink.push(self.frames, self.memory[0xF00:])
+        if self.draw_flag or self.frame_pending:
+            self.frame_pending = not self.ui.display_framebuffer(
+                    self.memory[0xF00:])
+            self.draw_flag = False
+        if self.throttle:
+            self.wait_frame()
+        if self.reload:
+            self.check_reload()
+
+    # Runs ips / frequency instructions per frame, ticking the timers and
+    # refreshing the display at the end of each frame. Frames are paced to
+    # the timers frequency when throttling, and run back to back otherwise.
+    # Returns when self.running is cleared, or once max_cycles instructions
+    # or max_frames frames have been executed by this call
+    def run(self, max_cycles=None, max_frames=None):
+        if max_cycles is not None:
+            max_cycles += self.cycles
+        if max_frames is not None:
+            max_frames += self.frames
+        self.next_frame = time.perf_counter_ns() + self.frame_period
+        if self.profiler is not None:
+            run_cycles = self.profiler.run
+        elif self.tracer is not None:
+            run_cycles = self.tracer.run
+        elif self.coverage is not None:
+            run_cycles = self.coverage.run
+        else:
+            run_cycles = self.run_blocks
+        while self.running:
+            if max_cycles is not None and self.cycles >= max_cycles:
+                break
+            if max_frames is not None and self.frames >= max_frames:
+                break
+
+            budget = self.frame_budget
+            if max_cycles is not None:
+                budget = min(budget, max_cycles - self.cycles)
+            if self.keys_frame != self.frames:
+                self.poll_keys()
+            start = self.cycles
+            self.waiting = False
+            if self.debugger is not None:
+                self.debugger.run(budget)
+            else:
+                run_cycles(budget)
+            self.frame_budget -= self.cycles - start
+
+            if self.waiting:
+                self.frame_budget = 0
+            if self.frame_budget <= 0:
+                self.end_frame()
+        return self.cycles
+
+def emulator_start(stdscr, args):
+    ui_args = {'debug': args.debug, 'refresh_rate': args.refresh,
+            'key_timeout': args.key_timeout}
+    if args.record:
+        script = inputs.InputScript(seed=args.seed, ips=args.ips,
+                frequency=args.frequency)
+        ui = RecordingUI(stdscr, script, **ui_args)
+    else:
+        ui = UI(stdscr, **ui_args)
+    cpu = CPU(ui, debug=args.debug, frequency=args.frequency, ips=args.ips,
+            seed=args.seed)
+    cpu.load_rom(args.rom)
+    cpu.reload = args.reload
+    if args.load_state:
+        cpu.load_state(args.load_state)
+    if args.debug:
+        cpu.debugger = debugger.Debugger(cpu, args.break_at,
+                args.watchpoint, args.breakpoint)
+    if args.profile:
+        profiler.Profiler(cpu)
+    elif args.trace:
+        trace.Tracer(cpu, args.trace_size)
+    if args.frames:
+        cpu.frame_sink = frames.open_sink(args.frames, args.frames_format,
+                args.frequency, args.frames_scale)
+    try:
+        cpu.run(max_cycles=args.max_cycles,
+                max_frames=args.max_frames)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.frames:
+            cpu.frame_sink.close(cpu.frames)
+        if args.save_state:
+            cpu.save_state(args.save_state)
+        if args.record:
+            script.save_binary(args.record)
+        if args.profile:
+            cpu.profiler.save(args.profile, args.profile_format)
+        if cpu.tracer is not None:
+            cpu.tracer.save(args.trace)
+
+def print_framebuffer(framebuffer):
+    for y in range(0, 32):
+        print(''.join('#' if (framebuffer[y * 8 + x // 8] >> (7 - x % 8)) & 1
+            else '.' for x in range(0, 64)))
+
+def headless_start(args, ui=None):
+    cpu = CPU(ui, frequency=args.frequency, ips=args.ips, throttle=False,
+            seed=args.seed)
+    cpu.load_rom(args.rom)
+    if args.load_state:
+        cpu.load_state(args.load_state)
+    if args.profile:
+        profiler.Profiler(cpu)
+    elif args.trace:
+        trace.Tracer(cpu, args.trace_size)
+    if args.frames:
+        cpu.frame_sink = frames.open_sink(args.frames, args.frames_format,
+                args.frequency, args.frames_scale)
+    try:
+        cpu.run(max_cycles=args.max_cycles, max_frames=args.max_frames)
+    finally:
+        if args.frames:
+            cpu.frame_sink.close(cpu.frames)
+        if args.save_state:
+            cpu.save_state(args.save_state)
+        if args.profile:
+            cpu.profiler.save(args.profile, args.profile_format)
+        if cpu.tracer is not None:
+            cpu.tracer.save(args.trace)
+    print('cycles: %d, frames: %d, PC: %s' % (cpu.cycles, cpu.frames,
+        hex(cpu.PC)))
+    print_framebuffer(cpu.get_framebuffer())
+
+# Replays a recorded input script headless, with the seed, instructions per
+# second and timers frequency of the recording
+def replay_start(args):
+    script = inputs.load_script(args.replay)
+    args.seed = script.seed if script.seed is not None else args.seed
+    args.ips = script.ips or args.ips
+    args.frequency = script.frequency or args.frequency
+    if args.max_cycles is None and args.max_frames is None:
+        args.max_frames = script.frames()
+    return headless_start(args, ScriptedUI(script))
 
 def main(argv):
     argp = argparse.ArgumentParser(description='Chip8 Emulator',
@@ -482,7 +909,96 @@ def main(argv):
             action="store_true", help="Enable debug mode")
     argp.add_argument("-f", "--frequency", type=int, default=60,
             help="Set timers frequency (default 60Hz)")
+    argp.add_argument("-i", "--ips", type=int, default=700,
+            help="Set instructions executed per second (default 700)")
     argp.add_argument("-b", "--breakpoint",
             action="store_true", help="Enable breakpoint at start")
+    argp.add_argument("-B", "--break-at", type=lambda s: int(s, 16),
+            action="append", default=[],
+            help="Break when PC reaches this (hexadecimal) address, implies "
+            "-d. Can be repeated")
+    argp.add_argument("-W", "--watchpoint", action="append", default=[],
+            help="Break on a write to a hexadecimal address or range ('F00', "
+            "'0xF00-0xFFF'), or when a condition on a register or memory "
+            "byte becomes true ('V3 == 0x10', 'I > 0x300', '[0x300] != 0'), "
+            "implies -d. Can be repeated")
+    argp.add_argument("-r", "--refresh", type=int, default=60,
+            help="Set maximum display refresh rate (default 60Hz, 0 for no "
+            "limit)")
+    argp.add_argument("-k", "--key-timeout", type=int,
+            default=UI.KEY_TIMEOUT, help="Set the number of frames a key "
+            "stays pressed after its last key press (default %d)"
+            % UI.KEY_TIMEOUT)
+    argp.add_argument("--headless", action="store_true",
+            help="Run without display, print the final screen on exit")
+    argp.add_argument("--max-cycles", type=int, default=None,
+            help="Stop after executing this many instructions")
+    argp.add_argument("--max-frames", type=int, default=None,
+            help="Stop after this many timer ticks")
+    argp.add_argument("--load-state", default=None,
+            help="Restore the machine state saved in this file after loading "
+            "the rom")
+    argp.add_argument("--save-state", default=None,
+            help="Save the machine state to this file on exit")
+    argp.add_argument("-s", "--seed", type=int, default=None,
+            help="Seed of the random number generator, a signed 64 bits "
+            "integer")
+    argp.add_argument("--record", default=None,
+            help="Record the key presses of each frame to this file")
+    argp.add_argument("--replay", default=None,
+            help="Replay a recorded (or text) input script headless, at full "
+            "speed")
+    argp.add_argument("--reload", action="store_true",
+            help="Reset and load the rom again whenever its file changes, "
+            "e.g. when assembled by chippy8 asm --watch")
+    argp.add_argument("--frames", default=None,
+            help="Write the displayed frames to this file (or directory, for "
+            "png)")
+    argp.add_argument("--frames-format", choices=frames.FORMATS,
+            default='gif', help="Format of the frames: animated gif, png "
+            "sequence or raw framebuffers (default gif)")
+    argp.add_argument("--frames-scale", type=int, default=4,
+            help="Size in image pixels of a screen pixel, for gif and png "
+            "(default 4)")
+    argp.add_argument("-t", "--trace", default=None,
+            help="Record the last instructions executed, and write them to "
+            "this file on exit or error, see chippy8 trace")
+    argp.add_argument("--trace-size", type=int, default=65536,
+            help="Number of instructions kept by --trace (default 65536)")
+    argp.add_argument("-p", "--profile", default=None,
+            help="Count and time the instructions executed, and write the "
+            "profile to this file on exit")
+    argp.add_argument("--profile-format", choices=['report', 'folded'],
+            default='report', help="Write the profile as a report of the "
+            "handlers and hot PCs, or as flamegraph folded stacks (default "
+            "report)")
     args = argp.parse_args(argv)
-    sys.exit(curses.wrapper(emulator_start, args.rom, args.debug, args.frequency, args.breakpoint))
+    if args.break_at or args.watchpoint:
+        args.debug = True
+    for expression in args.watchpoint:
+        try:
+            if debugger.parse_write(expression) is None:
+                debugger.compile_condition(expression)
+        except ValueError:
+            argp.error('Invalid watchpoint: %s' % expression)
+    # The profiler, the tracer and the debugger each run the instructions
+    # their own way: only one of them can be used
+    if args.trace and args.profile:
+        argp.error('-t and -p can not be used together')
+    if args.debug and not (args.headless or args.replay) \
+            and (args.trace or args.profile):
+        argp.error('-t and -p can not be used with the debugger (-d, -B, -W)')
+    # Seeds are recorded in input scripts as signed 64 bits integers
+    if args.seed is not None and not -2 ** 63 <= args.seed < 2 ** 63:
+        argp.error('The seed must be a signed 64 bits integer: %d'
+                % args.seed)
+    if args.record and args.seed is None:
+        args.seed = random.randrange(2 ** 63)
+    if args.replay:
+        return replay_start(args)
+    if args.headless:
+        if args.max_cycles is None and args.max_frames is None:
+            argp.error('--headless requires --max-cycles or --max-frames')
+        return headless_start(args)
+    import curses
+    sys.exit(curses.wrapper(emulator_start, args))
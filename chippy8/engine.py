@@ -0,0 +1,399 @@
+# Predecoded execution engine.
+#
+# Each address is decoded once into a closure with its operands already
+# bound. Straight-line code is chained into basic blocks, which end on the
+# first instruction that may change PC or write to memory, so that a whole
+# block runs per dispatch.
+#
+# A few common instruction sequences are fused into a single closure: runs of
+# LD Vx, nn, ADD I, Vx followed by LD Vy, [I], and timer waits (LD Vx, DT;
+# SE Vx, 0x00; JP back to the LD), which skip ahead to the end of the frame
+# instead of spinning.
+
+import operator
+
+MAX_BLOCK_LENGTH = 64
+
+
+class Block:
+    def __init__(self, start, end, ops, length, addresses, indices):
+        self.start = start
+        self.end = end
+        self.ops = ops
+        # Number of instructions, fused ops running several
+        self.length = length
+        # Address of the instruction each op may raise an error at, and
+        # number of instructions of the block run before that one
+        self.addresses = addresses
+        self.indices = indices
+
+    # Rewinds the CPU to the instruction that raised an error while ops, the
+    # iterator over self.ops, was running the block from its start: PC is set
+    # to its address and the instructions run before it are counted
+    def fault(self, cpu, ops):
+        i = len(self.ops) - operator.length_hint(ops) - 1
+        cpu.PC = self.addresses[i]
+        cpu.cycles += self.indices[i]
+
+
+# Fallback for instructions without a specialized closure: runs the regular
+# CPU handler on the bound opcode
+def compile_handler(cpu, opcode):
+    handler = cpu.LOOKUP_TABLE[opcode & 0xF000]
+
+    def op():
+        cpu.opcode = opcode
+        handler()
+    return op
+
+
+# Returns (closure, ends_block) for an opcode
+def compile_op(cpu, opcode):
+    V = cpu.V
+    memory = cpu.memory
+    x = (opcode & 0x0F00) >> 8
+    y = (opcode & 0x00F0) >> 4
+    nn = opcode & 0x00FF
+    nnn = opcode & 0x0FFF
+    kind = opcode & 0xF000
+
+    if kind == 0x0000:
+        if opcode == 0x00EE:
+            def op():
+                cpu.PC = cpu.stack.pop()
+            return op, True
+        if opcode == 0x00E0:
+            return compile_handler(cpu, opcode), True
+        def op():
+            pass
+        return op, False
+
+    if kind == 0x1000:
+        def op():
+            cpu.PC = nnn
+        return op, True
+
+    if kind == 0x2000:
+        def op():
+            cpu.stack.append(cpu.PC)
+            cpu.PC = nnn
+        return op, True
+
+    if kind == 0x3000:
+        def op():
+            if V[x] == nn:
+                cpu.PC += 2
+        return op, True
+
+    if kind == 0x4000:
+        def op():
+            if V[x] != nn:
+                cpu.PC += 2
+        return op, True
+
+    if kind == 0x5000:
+        def op():
+            if V[x] == V[y]:
+                cpu.PC += 2
+        return op, True
+
+    if kind == 0x6000:
+        def op():
+            V[x] = nn
+        return op, False
+
+    if kind == 0x7000:
+        def op():
+            V[x] = (V[x] + nn) & 0xFF
+        return op, False
+
+    if kind == 0x8000:
+        return compile_op_8(cpu, opcode, x, y)
+
+    if kind == 0x9000:
+        def op():
+            if V[x] != V[y]:
+                cpu.PC += 2
+        return op, True
+
+    if kind == 0xA000:
+        def op():
+            cpu.I = nnn
+        return op, False
+
+    if kind == 0xB000:
+        def op():
+            cpu.PC = nnn + V[0]
+        return op, True
+
+    if kind == 0xC000:
+        return compile_handler(cpu, opcode), False
+
+    if kind == 0xE000:
+        keys = cpu.keys
+        if nn == 0x9E:
+            def op():
+                key = V[x]
+                if key < 0x10 and keys[key]:
+                    cpu.PC += 2
+            return op, True
+        if nn == 0xA1:
+            def op():
+                key = V[x]
+                if key >= 0x10 or not keys[key]:
+                    cpu.PC += 2
+            return op, True
+
+    if kind == 0xF000:
+        sub = opcode & 0x00FF
+        if sub == 0x07:
+            def op():
+                V[x] = cpu.DT
+            return op, False
+        if sub == 0x15:
+            def op():
+                cpu.DT = V[x]
+            return op, False
+        if sub == 0x18:
+            def op():
+                cpu.ST = V[x]
+            return op, False
+        if sub == 0x1E:
+            def op():
+                cpu.I = 0xFFFF & (cpu.I + V[x])
+            return op, False
+        if sub == 0x29:
+            def op():
+                cpu.I = V[x] * 5
+            return op, False
+        # Memory writes end the block, as they may overwrite its code. The
+        # invalidation is looked up on each call, as the debugger wraps it
+        if sub == 0x33:
+            handler = compile_handler(cpu, opcode)
+            def op():
+                i = cpu.I
+                if i + 2 < 0x1000:
+                    v = V[x]
+                    memory[i] = v // 100
+                    memory[i + 1] = v // 10 % 10
+                    memory[i + 2] = v % 10
+                    cpu.code_cache.invalidate(i, i + 3)
+                else:
+                    handler()
+            return op, True
+        if sub == 0x55:
+            handler = compile_handler(cpu, opcode)
+            def op():
+                i = cpu.I
+                if i + x < 0x1000:
+                    memory[i:i + x + 1] = V[0:x + 1]
+                    cpu.code_cache.invalidate(i, i + x + 1)
+                else:
+                    handler()
+            return op, True
+        if sub == 0x65:
+            handler = compile_handler(cpu, opcode)
+            def op():
+                i = cpu.I
+                if i + x < 0x1000:
+                    V[0:x + 1] = memory[i:i + x + 1]
+                else:
+                    handler()
+            return op, False
+
+    # 0xD000 and the remaining instructions draw, wait for a key, write memory
+    # or are invalid: they always end the block
+    return compile_handler(cpu, opcode), True
+
+
+def compile_op_8(cpu, opcode, x, y):
+    V = cpu.V
+    sub = opcode & 0x000F
+
+    if sub == 0x0:
+        def op():
+            V[x] = V[y]
+    elif sub == 0x1:
+        def op():
+            V[x] |= V[y]
+    elif sub == 0x2:
+        def op():
+            V[x] &= V[y]
+    elif sub == 0x3:
+        def op():
+            V[x] ^= V[y]
+    elif sub == 0x4:
+        def op():
+            val = V[x] + V[y]
+            V[x] = val & 0xFF
+            V[0xF] = 1 if val > 255 else 0
+    elif sub == 0x5:
+        def op():
+            V[0xF] = 1 if V[x] > V[y] else 0
+            V[x] = 0xFF & (V[x] - V[y])
+    elif sub == 0x6:
+        def op():
+            V[0xF] = V[x] & 0x01
+            V[x] = V[x] >> 1
+    elif sub == 0x7:
+        def op():
+            V[0xF] = 1 if V[y] > V[x] else 0
+            V[x] = 0xFF & (V[y] - V[x])
+    elif sub == 0xE:
+        def op():
+            V[0xF] = (V[x] >> 7) & 0x1
+            V[x] = 0xFF & (V[x] << 1)
+    else:
+        # Invalid: raises from the regular handler when executed
+        return compile_handler(cpu, opcode), True
+    return op, False
+
+
+# Returns the closure of LD Vx, nn instructions run in sequence
+def compile_loads(cpu, opcodes):
+    V = cpu.V
+    xs = [(opcode & 0x0F00) >> 8 for opcode in opcodes]
+    values = bytes(opcode & 0x00FF for opcode in opcodes)
+    if xs == list(range(xs[0], xs[0] + len(xs))):
+        start = xs[0]
+        end = start + len(xs)
+
+        def op():
+            V[start:end] = values
+    else:
+        loads = tuple(zip(xs, values))
+
+        def op():
+            for x, nn in loads:
+                V[x] = nn
+    return op
+
+
+# Returns the closure of ADD I, Vx followed by LD Vy, [I]
+def compile_add_read(cpu, add, read):
+    V = cpu.V
+    memory = cpu.memory
+    x = (add & 0x0F00) >> 8
+    y = (read & 0x0F00) >> 8
+    handler = compile_handler(cpu, read)
+
+    def op():
+        i = cpu.I = 0xFFFF & (cpu.I + V[x])
+        if i + y < 0x1000:
+            V[0:y + 1] = memory[i:i + y + 1]
+        else:
+            handler()
+    return op
+
+
+# Returns the closure of the timer wait loop LD Vx, DT; SE Vx, 0x00; JP start,
+# compiled as a block of 3 instructions. DT cannot change before the end of
+# the frame, so while it is not zero the loop runs the instructions left in
+# the frame (cpu.cycles_end) at once, ending at the PC the loop would have
+# reached
+def compile_timer_wait(cpu, start, opcode):
+    V = cpu.V
+    x = (opcode & 0x0F00) >> 8
+
+    def op():
+        dt = V[x] = cpu.DT
+        if dt == 0:
+            # The JP is skipped
+            cpu.PC = start + 6
+            cpu.cycles -= 1
+            return
+        left = cpu.cycles_end - cpu.cycles - 3
+        if left > 0:
+            cpu.cycles += left
+            cpu.PC = start + 2 * (left % 3)
+        else:
+            cpu.PC = start
+    return op
+
+
+def is_timer_wait(opcodes, start):
+    return len(opcodes) == 3 and opcodes[0] & 0xF0FF == 0xF007 \
+            and opcodes[1] == 0x3000 | (opcodes[0] & 0x0F00) \
+            and opcodes[2] == 0x1000 | (start & 0xFFF)
+
+
+class BlockCache:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}
+        # Marks the addresses covered by a cached block
+        self.code_map = bytearray(0x1000)
+
+    def get(self, pc):
+        block = self.blocks.get(pc)
+        if block is None:
+            block = self.compile(pc)
+            self.blocks[pc] = block
+        return block
+
+    # Returns the opcode at pc, marking it as code
+    def fetch(self, pc):
+        memory = self.cpu.memory
+        self.code_map[pc & 0xFFF] = 1
+        self.code_map[(pc + 1) & 0xFFF] = 1
+        return memory[pc & 0xFFF] << 8 | memory[(pc + 1) & 0xFFF]
+
+    def compile(self, start):
+        ops = []
+        addresses = []
+        indices = []
+        length = 0
+        pc = start
+        while length < MAX_BLOCK_LENGTH:
+            opcode = self.fetch(pc)
+            if opcode & 0xF0FF == 0xF007 and is_timer_wait([opcode,
+                self.fetch(pc + 2), self.fetch(pc + 4)], pc):
+                # Timer waits get a block of their own
+                if length == 0:
+                    return Block(start, pc + 6, [compile_timer_wait(self.cpu,
+                        pc, opcode)], 3, [pc], [0])
+                break
+            if opcode & 0xF000 == 0x6000:
+                loads = [opcode]
+                while length + len(loads) < MAX_BLOCK_LENGTH:
+                    opcode = self.fetch(pc + 2 * len(loads))
+                    if opcode & 0xF000 != 0x6000:
+                        break
+                    loads.append(opcode)
+                if len(loads) > 1:
+                    ops.append(compile_loads(self.cpu, loads))
+                    addresses.append(pc)
+                    indices.append(length)
+                    length += len(loads)
+                    pc += 2 * len(loads)
+                    continue
+                opcode = loads[0]
+            elif opcode & 0xF0FF == 0xF01E \
+                    and length + 1 < MAX_BLOCK_LENGTH:
+                read = self.fetch(pc + 2)
+                if read & 0xF0FF == 0xF065:
+                    # Only the read may raise an error
+                    ops.append(compile_add_read(self.cpu, opcode, read))
+                    addresses.append(pc + 2)
+                    indices.append(length + 1)
+                    length += 2
+                    pc += 4
+                    continue
+            op, ends_block = compile_op(self.cpu, opcode)
+            ops.append(op)
+            addresses.append(pc)
+            indices.append(length)
+            length += 1
+            pc += 2
+            if ends_block:
+                break
+        return Block(start, pc, ops, length, addresses, indices)
+
+    # Drops every cached block if [start, end[ overlaps decoded code
+    def invalidate(self, start, end):
+        if self.code_map.find(1, start & 0xFFF, end) >= 0:
+            self.clear()
+
+    def clear(self):
+        self.blocks.clear()
+        self.code_map = bytearray(0x1000)
@@ -0,0 +1,224 @@
+import os
+import queue
+import struct
+import threading
+import zlib
+
+WIDTH = 64
+HEIGHT = 32
+
+# Raw frame files: this header, then one (frame index, 256 bytes framebuffer)
+# record per frame, the framebuffer holding 8 bytes per row, MSB first
+RAW_MAGIC = b'C8FR'
+RAW_VERSION = 1
+RAW_HEADER = struct.Struct('>4sBBB')
+RAW_RECORD = struct.Struct('>I')
+
+FORMATS = ['gif', 'png', 'raw']
+
+
+# Returns the rows of a framebuffer as lists of 0 / 1 pixels, each pixel
+# repeated scale times in both directions
+def scale_rows(framebuffer, scale):
+    rows = []
+    for y in range(0, HEIGHT):
+        row = []
+        for byte in framebuffer[y * 8:y * 8 + 8]:
+            for bit in range(7, -1, -1):
+                row += [(byte >> bit) & 1] * scale
+        rows += [row] * scale
+    return rows
+
+
+# Receives the frames displayed by a CPU, and writes them from a background
+# thread so that encoding does not slow down the emulation. A frame identical
+# to the previous one is dropped, the previous frame lasting longer instead
+class FrameSink:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.last = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    # Queues the framebuffer displayed from frame index on
+    def push(self, index, framebuffer):
+        framebuffer = bytes(framebuffer)
+        if framebuffer != self.last:
+            self.last = framebuffer
+            self.queue.put((index, framebuffer))
+
+    # Waits for the queued frames to be written, index being the frame at
+    # which the last one stopped being displayed
+    def close(self, index):
+        self.queue.put((index, None))
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        try:
+            while True:
+                index, framebuffer = self.queue.get()
+                if framebuffer is None:
+                    self.finish(index)
+                    return
+                self.write(index, framebuffer)
+        except Exception as e:
+            self.error = e
+
+    def write(self, index, framebuffer):
+        raise NotImplementedError
+
+    def finish(self, index):
+        pass
+
+
+class RawSink(FrameSink):
+    def __init__(self, path):
+        super().__init__()
+        self.fout = open(path, 'wb')
+        self.fout.write(RAW_HEADER.pack(RAW_MAGIC, RAW_VERSION, WIDTH,
+            HEIGHT))
+
+    def write(self, index, framebuffer):
+        self.fout.write(RAW_RECORD.pack(index) + framebuffer)
+
+    def finish(self, index):
+        self.fout.close()
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data \
+            + struct.pack('>I', zlib.crc32(kind + data))
+
+
+# Returns a 1 bit grayscale PNG image of a framebuffer
+def encode_png(framebuffer, scale=1):
+    width = WIDTH * scale
+    data = bytearray()
+    for row in scale_rows(framebuffer, scale):
+        data.append(0)
+        for x in range(0, width, 8):
+            byte = 0
+            for pixel in row[x:x + 8]:
+                byte = byte << 1 | pixel
+            data.append(byte)
+    return b'\x89PNG\r\n\x1a\n' \
+            + png_chunk(b'IHDR', struct.pack('>IIBBBBB', width,
+                HEIGHT * scale, 1, 0, 0, 0, 0)) \
+            + png_chunk(b'IDAT', zlib.compress(bytes(data), 9)) \
+            + png_chunk(b'IEND', b'')
+
+
+# Writes each frame to DIRECTORY/INDEX.png, INDEX being its frame index
+class PNGSink(FrameSink):
+    def __init__(self, path, scale=1):
+        super().__init__()
+        self.path = path
+        self.scale = scale
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, index, framebuffer):
+        with open(os.path.join(self.path, '%06d.png' % index), 'wb') as fout:
+            fout.write(encode_png(framebuffer, self.scale))
+
+
+# Returns the GIF LZW compressed data of pixels, in 255 bytes sub-blocks
+def lzw_encode(pixels, min_code_size=2):
+    clear = 1 << min_code_size
+    out = bytearray()
+    bits = 0
+    nbits = 0
+    code_size = min_code_size + 1
+    table = {}
+    next_code = clear + 2
+
+    def emit(code):
+        nonlocal bits, nbits
+        bits |= code << nbits
+        nbits += code_size
+        while nbits >= 8:
+            out.append(bits & 0xFF)
+            bits >>= 8
+            nbits -= 8
+
+    emit(clear)
+    code = pixels[0]
+    for pixel in pixels[1:]:
+        key = code << 8 | pixel
+        extended = table.get(key)
+        if extended is not None:
+            code = extended
+            continue
+        emit(code)
+        if next_code == 4096:
+            emit(clear)
+            table = {}
+            next_code = clear + 2
+            code_size = min_code_size + 1
+        else:
+            table[key] = next_code
+            if next_code == 1 << code_size:
+                code_size += 1
+            next_code += 1
+        code = pixel
+    emit(code)
+    emit(clear + 1)
+    if nbits:
+        out.append(bits & 0xFF)
+    return b''.join(bytes([len(out[i:i + 255])]) + out[i:i + 255]
+            for i in range(0, len(out), 255)) + b'\x00'
+
+
+# Writes the frames as a looping animated GIF, each frame lasting until the
+# next one at the timers frequency. A frame is only written once the next one
+# is received, as its duration is not known before
+class GIFSink(FrameSink):
+    def __init__(self, path, frequency=60, scale=1):
+        super().__init__()
+        self.frequency = frequency
+        self.scale = scale
+        self.pending = None
+        self.fout = open(path, 'wb')
+        self.fout.write(b'GIF89a' + struct.pack('<HHBBB', WIDTH * scale,
+            HEIGHT * scale, 0x80, 0, 0) + b'\x00\x00\x00\xff\xff\xff'
+            + b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    # Centiseconds elapsed from frame 0 to frame index
+    def centiseconds(self, index):
+        return index * 100 // self.frequency
+
+    def write(self, index, framebuffer):
+        if self.pending is not None:
+            self.write_image(*self.pending, index)
+        self.pending = (index, framebuffer)
+
+    def write_image(self, index, framebuffer, end):
+        delay = self.centiseconds(end) - self.centiseconds(index)
+        pixels = bytes(pixel for row in scale_rows(framebuffer, self.scale)
+                for pixel in row)
+        self.fout.write(b'\x21\xf9\x04\x00' + struct.pack('<H', max(delay, 1))
+                + b'\x00\x00' + b'\x2c' + struct.pack('<HHHHB', 0, 0,
+                    WIDTH * self.scale, HEIGHT * self.scale, 0)
+                + b'\x02' + lzw_encode(pixels))
+
+    def finish(self, index):
+        if self.pending is not None:
+            self.write_image(*self.pending, max(index, self.pending[0] + 1))
+        self.fout.write(b'\x3b')
+        self.fout.close()
+
+
+# Returns a started sink writing frames to path in output_format
+def open_sink(path, output_format='gif', frequency=60, scale=1):
+    if output_format == 'raw':
+        sink = RawSink(path)
+    elif output_format == 'png':
+        sink = PNGSink(path, scale)
+    else:
+        sink = GIFSink(path, frequency, scale)
+    return sink.start()
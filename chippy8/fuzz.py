@@ -0,0 +1,373 @@
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+import chippy8.inputs as inputs
+from chippy8.emulator import CPU, ScriptedUI
+
+# Size of the edge coverage bitmaps. The edge from the block at PC a to the
+# block at PC b sets byte (a << 3) ^ (b >> 1), PCs being below 0x1000
+MAP_SIZE = 0x8000
+
+# Longest run of frames inserted or resized by a mutation
+MAX_RUN_FRAMES = 60
+
+# Runs tried to minimize a crashing input
+MAX_MINIMIZE_RUNS = 1000
+
+
+# Runs a CPU as CPU.run_blocks, recording the edges between the executed
+# blocks in a bitmap. Attaching a Coverage makes CPU.run use Coverage.run. A
+# PC past the end of memory, which the CPU would wrap around, raises an
+# IndexError
+class Coverage:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.clear()
+        cpu.coverage = self
+
+    def clear(self):
+        self.edges = bytearray(MAP_SIZE)
+        # Previous block PC, shifted, and PC of the instruction that raised an
+        # error
+        self.prev = 0
+        self.pc = None
+
+    def run(self, max_cycles):
+        cpu = self.cpu
+        cache = cpu.code_cache
+        blocks = cache.blocks
+        edges = self.edges
+        prev = self.prev
+        end = cpu.cycles_end = cpu.cycles + max_cycles
+        pc = cpu.PC
+        try:
+            while cpu.cycles < end and not cpu.waiting:
+                pc = cpu.PC
+                if pc > 0xFFE:
+                    raise IndexError('PC out of memory: %s' % hex(pc))
+                edges[prev ^ pc >> 1] = 1
+                prev = pc << 3
+                block = blocks.get(pc) or cache.get(pc)
+                if cpu.cycles + block.length > end or block.end > 0x1000:
+                    cpu.step()
+                    continue
+                cpu.PC = block.end
+                ops = iter(block.ops)
+                try:
+                    for op in ops:
+                        op()
+                except Exception:
+                    block.fault(cpu, ops)
+                    pc = cpu.PC
+                    raise
+                cpu.cycles += block.length
+        except Exception:
+            self.pc = pc
+            raise
+        finally:
+            self.prev = prev
+
+
+# Returns runs without empty runs, adjacent runs of the same keys merged, and
+# cut after frames frames
+def compact(runs, frames):
+    compacted = []
+    for run_frames, mask in runs:
+        run_frames = min(run_frames, frames)
+        frames -= run_frames
+        if run_frames <= 0:
+            continue
+        if compacted and compacted[-1][1] == mask:
+            compacted[-1] = (compacted[-1][0] + run_frames, mask)
+        else:
+            compacted.append((run_frames, mask))
+    return compacted
+
+
+def random_mask(rng):
+    return rng.choice([0, 1 << rng.randrange(0, 0x10)])
+
+
+def mutate_key(rng, runs, other):
+    i = rng.randrange(0, len(runs))
+    runs[i] = (runs[i][0], runs[i][1] ^ 1 << rng.randrange(0, 0x10))
+
+
+def mutate_press(rng, runs, other):
+    i = rng.randrange(0, len(runs))
+    runs[i] = (runs[i][0], random_mask(rng))
+
+
+def mutate_length(rng, runs, other):
+    i = rng.randrange(0, len(runs))
+    frames = runs[i][0]
+    runs[i] = (rng.choice([max(frames // 2, 1), frames * 2,
+        rng.randint(1, MAX_RUN_FRAMES)]), runs[i][1])
+
+
+def mutate_insert(rng, runs, other):
+    runs.insert(rng.randint(0, len(runs)), (rng.randint(1, MAX_RUN_FRAMES),
+        random_mask(rng)))
+
+
+def mutate_delete(rng, runs, other):
+    del runs[rng.randrange(0, len(runs))]
+
+
+# Replaces the end of runs by the end of another corpus input
+def mutate_splice(rng, runs, other):
+    runs[rng.randint(0, len(runs)):] \
+            = other.runs[rng.randint(0, len(other.runs)):]
+
+
+MUTATIONS = [mutate_key, mutate_press, mutate_length, mutate_insert,
+        mutate_delete, mutate_splice]
+
+
+# Returns (seed, runs) of the inputs simpler than runs tried by the
+# minimization: without one of the runs, with a run halved, or with one of
+# its keys released
+def simplifications(seed, runs):
+    for i in range(0, len(runs)):
+        yield seed, runs[:i] + runs[i + 1:]
+    for i, (frames, mask) in enumerate(runs):
+        if frames > 1:
+            yield seed, runs[:i] + [(frames // 2, mask)] + runs[i + 1:]
+    for i, (frames, mask) in enumerate(runs):
+        for key in range(0, 0x10):
+            if mask >> key & 1:
+                yield seed, runs[:i] + [(frames, mask & ~(1 << key))] \
+                        + runs[i + 1:]
+
+
+# Returns the crash signature of an error raised by the instruction at pc
+def signature(error, pc):
+    return '%s: %s at %s' % (type(error).__name__, error, hex(pc))
+
+
+# Coverage guided fuzzer of a rom's keypad inputs and random seed. Inputs are
+# input scripts run headless for max_frames frames, each from the state after
+# loading the rom. Mutated corpus inputs that reach new edges join the corpus,
+# and the ones raising an error are minimized and saved as crashes, once per
+# signature (error and instruction).
+#
+# The CPU is rewound between runs rather than reset, so that the blocks
+# compiled by a run are reused by the next ones
+class Fuzzer:
+    def __init__(self, program, output, max_frames=600, ips=700,
+            frequency=60, seed=None):
+        self.output = output
+        self.max_frames = max_frames
+        self.random = random.Random(seed)
+        self.cpu = CPU(ips=ips, frequency=frequency, throttle=False)
+        self.cpu.load_program(program)
+        self.initial = self.cpu.snapshot()
+        self.memory = int.from_bytes(self.cpu.memory, 'big')
+        self.code_map = None
+        self.coverage = Coverage(self.cpu)
+        # Edges, and code addresses, reached by every run, as bitmaps
+        self.edges = 0
+        self.code = 0
+        self.corpus = []
+        self.crashes = {}
+        self.runs = 0
+        self.cycles = 0
+        os.makedirs(os.path.join(output, 'corpus'), exist_ok=True)
+        os.makedirs(os.path.join(output, 'crashes'), exist_ok=True)
+
+    # Restores the CPU state after loading the rom. The compiled blocks are
+    # kept, unless the last run wrote to the code they were compiled from
+    def rewind(self, script):
+        cpu = self.cpu
+        cache = cpu.code_cache
+        blocks = {}
+        if cache.code_map is self.code_map and not (self.memory
+                ^ int.from_bytes(cpu.memory, 'big')) \
+                & int.from_bytes(cache.code_map, 'big') * 0xFF:
+            blocks = dict(cache.blocks)
+            code_map = bytes(cache.code_map)
+        cpu.restore(self.initial)
+        if blocks:
+            cache.blocks.update(blocks)
+            cache.code_map[:] = code_map
+        self.code_map = cache.code_map
+        # The seed is part of the input, replacing the snapshot's generator
+        # state as a CPU created with that seed would have it
+        cpu.random.seed(script.seed)
+        cpu.ui = ScriptedUI(script)
+        self.coverage.clear()
+
+    # Runs an input script, and returns its crash signature or None
+    def execute(self, script):
+        cpu = self.cpu
+        self.rewind(script)
+        crash = None
+        try:
+            cpu.run(max_frames=self.max_frames)
+        except Exception as e:
+            crash = signature(e, self.coverage.pc)
+        self.runs += 1
+        self.cycles += cpu.cycles
+        return crash
+
+    # Adds the edges of the last run to the coverage, and returns the number
+    # of new ones
+    def merge(self):
+        edges = int.from_bytes(self.coverage.edges, 'big')
+        new = edges & ~self.edges
+        self.edges |= edges
+        self.code |= int.from_bytes(self.cpu.code_cache.code_map, 'big')
+        return bin(new).count('1')
+
+    def script(self, seed, runs):
+        return inputs.InputScript(runs, seed, self.cpu.ips,
+                self.cpu.frequency)
+
+    # Returns the input script after frames frames of script, the last run
+    # being cut
+    def cut(self, script, frames):
+        return self.script(script.seed, compact(script.runs, frames))
+
+    # Returns a mutated copy of a corpus input
+    def mutate(self, script):
+        rng = self.random
+        seed = script.seed
+        runs = list(script.runs)
+        for _ in range(0, rng.randint(1, 4)):
+            if rng.randrange(0, 8) == 0:
+                seed = rng.randrange(0, 2 ** 32)
+            elif runs:
+                rng.choice(MUTATIONS)(rng, runs, rng.choice(self.corpus))
+            else:
+                mutate_insert(rng, runs, None)
+        return self.script(seed, compact(runs, self.max_frames))
+
+    def save(self, script, directory, name=None):
+        if name is None:
+            name = hashlib.sha1(script.pack()).hexdigest()[:16]
+        path = os.path.join(self.output, directory, name + '.c8in')
+        script.save_binary(path)
+        return path
+
+    # Returns the simplest input found raising the same crash as script: runs
+    # are removed, halved and their keys released while the crash stays the
+    # same, and the frames after the crash are dropped
+    def minimize(self, script, crash):
+        attempts = 0
+        changed = True
+        while changed and attempts < MAX_MINIMIZE_RUNS:
+            changed = False
+            for seed, runs in simplifications(script.seed, script.runs):
+                attempts += 1
+                candidate = self.script(seed, runs)
+                if self.execute(candidate) == crash:
+                    script = self.cut(candidate, self.cpu.frames + 1)
+                    changed = True
+                    break
+                if attempts >= MAX_MINIMIZE_RUNS:
+                    break
+        return script
+
+    # Runs an input, adding it to the corpus if it reached new edges or keep
+    # is set. Returns the crash signature, minimizing and saving the first
+    # input raising it
+    def test(self, script, keep=False, save=True):
+        crash = self.execute(script)
+        frames = self.cpu.frames
+        new = self.merge()
+        if crash is not None:
+            if crash not in self.crashes:
+                script = self.minimize(self.cut(script, frames + 1), crash)
+                name = '%s-%s' % (crash.split(':')[0], hashlib.sha1(
+                    crash.encode()).hexdigest()[:12])
+                self.crashes[crash] = self.save(script, 'crashes', name)
+                self.report('crash %s, saved to %s' % (crash,
+                    self.crashes[crash]))
+            return crash
+        if new or keep:
+            self.corpus.append(script)
+            if save:
+                self.save(script, 'corpus')
+        return None
+
+    def status(self):
+        return '%d runs, %d corpus, %d edges, %d code bytes, %d crashes' \
+                % (self.runs, len(self.corpus), bin(self.edges).count('1'),
+                        bin(self.code).count('1'), len(self.crashes))
+
+    def report(self, message):
+        sys.stdout.write(message + '\n')
+        sys.stdout.flush()
+
+    # Fuzzes until max_runs inputs were run or duration seconds elapsed,
+    # printing the status every second
+    def run(self, max_runs=None, duration=None):
+        start = time.monotonic()
+        last_report = start
+        last_cycles = self.cycles
+        while max_runs is None or self.runs < max_runs:
+            self.test(self.mutate(self.random.choice(self.corpus)))
+            now = time.monotonic()
+            if now - last_report >= 1:
+                self.report('%s, %d ips' % (self.status(), (self.cycles
+                    - last_cycles) / (now - last_report)))
+                last_report = now
+                last_cycles = self.cycles
+            if duration is not None and now - start >= duration:
+                break
+
+
+def load_corpus(path):
+    if not os.path.isdir(path):
+        return []
+    return [inputs.load_script(os.path.join(path, name))
+            for name in sorted(os.listdir(path))]
+
+
+def main(argv):
+    argp = argparse.ArgumentParser(description='Chip8 coverage guided fuzzer',
+            prog='chippy8 fuzz')
+    argp.add_argument("rom", help="Rom file to fuzz")
+    argp.add_argument("-o", "--output", required=True,
+            help="Directory of the corpus and crashes, an existing corpus "
+            "being fuzzed again")
+    argp.add_argument("-n", "--inputs", nargs='+', default=[],
+            help="Input script files to start the corpus from")
+    argp.add_argument("-i", "--ips", type=int, default=700,
+            help="Set instructions executed per second of emulated time "
+            "(default 700)")
+    argp.add_argument("-f", "--frequency", type=int, default=60,
+            help="Set timers frequency (default 60Hz)")
+    argp.add_argument("--max-frames", type=int, default=600,
+            help="Frames run per input (default 600)")
+    argp.add_argument("--runs", type=int, default=None,
+            help="Stop after running this many inputs")
+    argp.add_argument("--duration", type=float, default=None,
+            help="Stop after this many seconds")
+    argp.add_argument("-s", "--seed", type=int, default=None,
+            help="Seed of the fuzzer's mutations")
+    args = argp.parse_args(argv)
+    with open(args.rom, 'rb') as fin:
+        program = fin.read(4096 - 0x200)
+    fuzzer = Fuzzer(program, args.output, args.max_frames, args.ips,
+            args.frequency, args.seed)
+
+    resumed = load_corpus(os.path.join(args.output, 'corpus'))
+    for script in resumed:
+        fuzzer.test(fuzzer.script(script.seed or 0, script.runs), True, False)
+    for path in args.inputs:
+        script = inputs.load_script(path)
+        fuzzer.test(fuzzer.script(script.seed or 0, script.runs), True)
+    if not fuzzer.corpus:
+        fuzzer.test(fuzzer.script(0, []), True)
+    if not fuzzer.corpus:
+        argp.error('every initial input crashes')
+    try:
+        fuzzer.run(args.runs, args.duration)
+    except KeyboardInterrupt:
+        pass
+    fuzzer.report(fuzzer.status())
+    return 1 if fuzzer.crashes else 0
@@ -0,0 +1,79 @@
+import struct
+
+# Binary input scripts: this header, then one (frames, mask) run per entry
+SCRIPT_MAGIC = b'C8IN'
+SCRIPT_VERSION = 1
+SCRIPT_HEADER = struct.Struct('>4sBqIHI')
+SCRIPT_RUN = struct.Struct('>IH')
+
+
+# Keypad input script: a list of (frames, mask) runs, bit k of mask being set
+# while key k is pressed. Recorded scripts also hold the random seed, the
+# instructions per second and the timers frequency of the recorded run.
+#
+# In text form, each line holds one run as "FRAMES MASK", MASK in hexadecimal,
+# '#' starting a comment
+class InputScript:
+    def __init__(self, runs=None, seed=None, ips=None, frequency=None):
+        self.runs = runs if runs is not None else []
+        self.seed = seed
+        self.ips = ips
+        self.frequency = frequency
+
+    def frames(self):
+        return sum(frames for frames, _ in self.runs)
+
+    # Appends one frame of key state, extending the last run if unchanged
+    def append(self, mask):
+        if self.runs and self.runs[-1][1] == mask:
+            self.runs[-1] = (self.runs[-1][0] + 1, mask)
+        else:
+            self.runs.append((1, mask))
+
+    def dumps(self):
+        return ''.join('%d 0x%04X\n' % run for run in self.runs)
+
+    def pack(self):
+        return SCRIPT_HEADER.pack(SCRIPT_MAGIC, SCRIPT_VERSION,
+                self.seed or 0, self.ips or 0, self.frequency or 0,
+                len(self.runs)) \
+                + b''.join(SCRIPT_RUN.pack(*run) for run in self.runs)
+
+    def save(self, path):
+        with open(path, 'w') as fout:
+            fout.write(self.dumps())
+
+    def save_binary(self, path):
+        with open(path, 'wb') as fout:
+            fout.write(self.pack())
+
+
+def loads_script(text):
+    runs = []
+    for line in text.splitlines():
+        line = line.split('#')[0].split()
+        if not line:
+            continue
+        if len(line) != 2:
+            raise ValueError('Invalid input script line: %s' % ' '.join(line))
+        runs.append((int(line[0]), int(line[1], 16)))
+    return InputScript(runs)
+
+
+def unpack_script(blob):
+    magic, version, seed, ips, frequency, count \
+            = SCRIPT_HEADER.unpack_from(blob)
+    if magic != SCRIPT_MAGIC or version != SCRIPT_VERSION:
+        raise ValueError('Unsupported input script format')
+    runs = [SCRIPT_RUN.unpack_from(blob, SCRIPT_HEADER.size
+        + i * SCRIPT_RUN.size) for i in range(count)]
+    return InputScript(runs, seed, ips or None, frequency or None)
+
+
+# Loads a binary or a text input script
+def load_script(path):
+    with open(path, 'rb') as fin:
+        blob = fin.read()
+    if blob.startswith(SCRIPT_MAGIC):
+        return unpack_script(blob)
+    return loads_script(blob.decode())
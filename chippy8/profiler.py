@@ -0,0 +1,117 @@
+import collections
+import time
+import chippy8.asm as asm
+
+# CPU methods timed besides the instruction handlers (lookup_* and t*_*)
+PROFILED_METHODS = ['poll_keys', 'end_frame', 'wait_frame']
+
+
+# Per handler execution counts and times, and per PC execution counts, of a
+# CPU. Attaching a profiler replaces the CPU handlers by timed wrappers, and
+# makes CPU.run single step through Profiler.run instead of the block engine,
+# so that a CPU without profiler runs unchanged.
+#
+# Times are recorded per call stack (e.g. run;lookup_f;tf_load_dt), as self
+# times, the time spent in the timed callees being subtracted
+class Profiler:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.stack = ['run']
+        self.children = [0]
+        self.calls = collections.Counter()
+        self.times = collections.Counter()
+        self.pcs = [0] * 0x1000
+        self.start = time.perf_counter_ns()
+        self.attach(cpu)
+
+    def attach(self, cpu):
+        names = [name for name in dir(cpu) if name.startswith('lookup_')
+                or (len(name) > 3 and name[0] == 't' and name[2] == '_')]
+        for name in names + PROFILED_METHODS:
+            setattr(cpu, name, self.wrap(name, getattr(cpu, name)))
+        cpu.ui.display_framebuffer = self.wrap('display_framebuffer',
+                cpu.ui.display_framebuffer)
+        for table in (cpu.LOOKUP_TABLE, cpu.LOOKUP_TABLE_8,
+                cpu.LOOKUP_TABLE_E, cpu.LOOKUP_TABLE_F):
+            for key, handler in table.items():
+                table[key] = getattr(cpu, handler.__name__)
+        cpu.profiler = self
+
+    def wrap(self, name, func):
+        stack = self.stack
+        children = self.children
+
+        def timed(*args):
+            stack.append(name)
+            children.append(0)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args)
+            finally:
+                elapsed = time.perf_counter_ns() - start
+                key = ';'.join(stack)
+                self.calls[key] += 1
+                self.times[key] += elapsed - children.pop()
+                children[-1] += elapsed
+                stack.pop()
+        timed.__name__ = name
+        return timed
+
+    # Single steps max_cycles instructions, as CPU.run_blocks
+    def run(self, max_cycles):
+        cpu = self.cpu
+        pcs = self.pcs
+        end = cpu.cycles + max_cycles
+        while cpu.cycles < end and not cpu.waiting:
+            pcs[cpu.PC & 0xFFF] += 1
+            cpu.step()
+
+    # Returns the calls and the total time, callees included, of each
+    # handler, sorted by total time
+    def handlers(self):
+        totals = collections.Counter()
+        calls = collections.Counter()
+        for key, count in self.calls.items():
+            names = key.split(';')
+            calls[names[-1]] += count
+            # Time of a recursive call is only counted once
+            for i, name in enumerate(names):
+                if name not in names[:i]:
+                    totals[name] += self.times[key]
+        return [(name, calls[name], total) for name, total
+                in totals.most_common() if name in calls]
+
+    def hot_pcs(self, count=20):
+        pcs = sorted(range(0x1000), key=lambda pc: -self.pcs[pc])
+        return [(pc, self.pcs[pc]) for pc in pcs[:count] if self.pcs[pc]]
+
+    def report(self):
+        elapsed = time.perf_counter_ns() - self.start
+        lines = ['%d instructions, %d frames in %.1f ms' % (self.cpu.cycles,
+            self.cpu.frames, elapsed / 10 ** 6), '',
+            '%-20s %10s %12s %10s %7s' % ('handler', 'calls', 'total ms',
+                'us/call', 'time')]
+        for name, calls, total in self.handlers():
+            lines.append('%-20s %10d %12.3f %10.3f %6.1f%%' % (name, calls,
+                total / 10 ** 6, total / calls / 10 ** 3,
+                100 * total / elapsed))
+        executed = sum(self.pcs) or 1
+        lines += ['', '%-8s %10s %7s  %s' % ('PC', 'count', 'share',
+            'instruction')]
+        for pc, count in self.hot_pcs():
+            opcode = self.cpu.memory[pc] << 8 | self.cpu.memory[pc + 1 & 0xFFF]
+            lines.append('%-8s %10d %6.1f%%  %s' % ('0x%03X' % pc, count,
+                100 * count / executed, asm.lookup_asm(opcode)
+                or '0x%04X' % opcode))
+        return '\n'.join(lines) + '\n'
+
+    # Folded stacks, one "stack self_time_ns" line per call stack, as read
+    # by flamegraph.pl and speedscope
+    def folded(self):
+        return ''.join('%s %d\n' % (key, ns) for key, ns
+                in sorted(self.times.items()))
+
+    def save(self, path, output_format='report'):
+        with open(path, 'w') as fout:
+            fout.write(self.folded() if output_format == 'folded'
+                    else self.report())
@@ -0,0 +1,401 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import stat
+import tempfile
+from chippy8.emulator import CPU, UI, HeadlessUI
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'chippy8.sock')
+
+# Bytes queued to a client after which its frame updates are dropped, the
+# client getting a full frame once it caught up
+MAX_CLIENT_BUFFER = 1 << 16
+
+# Frames behind schedule after which a session gives up catching up
+MAX_FRAME_LAG = 5
+
+# Highest timers frequency of a session
+MAX_FREQUENCY = 1000
+
+
+# Returns the {row: hex bytes} rows of framebuffer differing from previous
+def framebuffer_delta(previous, framebuffer):
+    rows = {}
+    for y in range(0, 32):
+        row = framebuffer[y * 8:y * 8 + 8]
+        if previous is None or row != previous[y * 8:y * 8 + 8]:
+            rows[y] = row.hex()
+    return rows
+
+
+# A headless CPU run frame by frame by its own task, at its timers
+# frequency. Each frame runs at most ips / frequency instructions, so that a
+# busy rom only delays the other sessions by one frame budget
+class Session:
+    def __init__(self, sid, owner, ips, frequency, seed):
+        self.id = sid
+        self.owner = owner
+        self.ui = HeadlessUI()
+        self.cpu = CPU(self.ui, frequency=frequency, ips=ips, throttle=False,
+                seed=seed)
+        self.subscribers = set()
+        self.framebuffer = None
+        self.task = None
+        self.error = None
+
+    def load(self, program):
+        self.cpu.reset()
+        self.cpu.load_program(program)
+        self.error = None
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        period = 1 / self.cpu.frequency
+        deadline = loop.time()
+        while True:
+            try:
+                self.cpu.run(max_frames=1)
+            except Exception as e:
+                self.error = '%s: %s' % (type(e).__name__, e)
+                for client in self.subscribers:
+                    client.send({'event': 'error', 'session': self.id,
+                        'error': self.error})
+                return
+            self.publish()
+            deadline += period
+            delay = deadline - loop.time()
+            if delay < -MAX_FRAME_LAG * period:
+                deadline = loop.time()
+            await asyncio.sleep(max(delay, 0))
+
+    def publish(self):
+        framebuffer = self.cpu.get_framebuffer()
+        if framebuffer == self.framebuffer:
+            return
+        rows = framebuffer_delta(self.framebuffer, framebuffer)
+        self.framebuffer = bytes(framebuffer)
+        for client in self.subscribers:
+            client.send_frame(self, rows)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        for client in list(self.subscribers):
+            client.subscriptions.discard(self.id)
+
+    def state(self):
+        cpu = self.cpu
+        return {'session': self.id, 'cycles': cpu.cycles,
+                'frames': cpu.frames, 'PC': cpu.PC, 'I': cpu.I, 'DT': cpu.DT,
+                'ST': cpu.ST, 'V': list(cpu.V), 'stack': cpu.stack,
+                'subscribers': len(self.subscribers), 'error': self.error}
+
+
+class Connection:
+    def __init__(self, writer):
+        self.writer = writer
+        self.subscriptions = set()
+        # Sessions whose frame updates were dropped
+        self.stale = set()
+
+    def send(self, message):
+        self.writer.write(json.dumps(message).encode() + b'\n')
+
+    # Sends the changed rows of a session frame, or the full frame after
+    # updates were dropped
+    def send_frame(self, session, rows):
+        if self.writer.transport.get_write_buffer_size() \
+                > MAX_CLIENT_BUFFER:
+            self.stale.add(session.id)
+            return
+        if session.id in self.stale:
+            self.stale.discard(session.id)
+            rows = framebuffer_delta(None, session.framebuffer)
+        self.send({'event': 'frame', 'session': session.id,
+            'frame': session.cpu.frames, 'rows': rows})
+
+
+# Hosts the sessions, and serves requests of one JSON object per line, such
+# as {"id": 1, "cmd": "create"}. Each request gets a response with the same
+# id, holding "error" on failure. Subscribed clients also receive "frame"
+# events with the changed framebuffer rows, and "error" events when a rom
+# fails
+class Server:
+    def __init__(self, max_ips=100000, max_sessions=1000, rom_dir=None):
+        self.max_ips = max_ips
+        self.max_sessions = max_sessions
+        # Directory "load" requests may read roms from by "path", if any
+        self.rom_dir = os.path.realpath(rom_dir) if rom_dir else None
+        self.sessions = {}
+        self.next_id = 1
+        self.COMMANDS = {
+            'create': self.cmd_create,
+            'load': self.cmd_load,
+            'key': self.cmd_key,
+            'subscribe': self.cmd_subscribe,
+            'unsubscribe': self.cmd_unsubscribe,
+            'state': self.cmd_state,
+            'list': self.cmd_list,
+            'close': self.cmd_close,
+        }
+
+    def session(self, request):
+        sid = request.get('session')
+        if sid not in self.sessions:
+            raise ValueError('Unknown session: %s' % sid)
+        return self.sessions[sid]
+
+    # Sessions are closed with the connection that created them, unless
+    # created with "keep": true. Instructions per frame are capped to those
+    # of a max_ips session at 60Hz, so that a low frequency does not make
+    # one frame hold back the other sessions
+    def cmd_create(self, connection, request):
+        if len(self.sessions) >= self.max_sessions:
+            raise ValueError('Too many sessions')
+        frequency = int(request.get('frequency', 60))
+        if not 0 < frequency <= MAX_FREQUENCY:
+            raise ValueError('Invalid frequency: %s' % frequency)
+        ips = min(int(request.get('ips', 700)), self.max_ips,
+                self.max_ips * frequency // 60)
+        session = Session(self.next_id,
+                None if request.get('keep') else connection,
+                ips, frequency, request.get('seed'))
+        self.sessions[session.id] = session
+        self.next_id += 1
+        return {'session': session.id}
+
+    # Loads a rom from "data" (base64) or "path", relative to the rom
+    # directory, and starts the session
+    def cmd_load(self, connection, request):
+        session = self.session(request)
+        if 'data' in request:
+            program = base64.b64decode(request['data'])
+        else:
+            if self.rom_dir is None:
+                raise ValueError('No rom directory, use data')
+            path = os.path.realpath(os.path.join(self.rom_dir,
+                request['path']))
+            if os.path.commonpath([path, self.rom_dir]) != self.rom_dir:
+                raise ValueError('Path outside the rom directory: %s'
+                        % request['path'])
+            with open(path, 'rb') as fin:
+                program = fin.read(4096 - 0x200)
+        session.load(program)
+        return {}
+
+    def cmd_key(self, connection, request):
+        session = self.session(request)
+        key = int(request['key'])
+        if not 0 <= key < 0x10:
+            raise ValueError('Invalid key: %s' % key)
+        if request.get('pressed', True):
+            session.ui.press_key(key)
+        else:
+            session.ui.release_key(key)
+        return {}
+
+    def cmd_subscribe(self, connection, request):
+        session = self.session(request)
+        session.subscribers.add(connection)
+        connection.subscriptions.add(session.id)
+        connection.stale.add(session.id)
+        if session.framebuffer is not None:
+            connection.send_frame(session, {})
+        return {}
+
+    def cmd_unsubscribe(self, connection, request):
+        session = self.session(request)
+        session.subscribers.discard(connection)
+        connection.subscriptions.discard(session.id)
+        return {}
+
+    def cmd_state(self, connection, request):
+        return self.session(request).state()
+
+    def cmd_list(self, connection, request):
+        return {'sessions': [session.state()
+            for session in self.sessions.values()]}
+
+    def cmd_close(self, connection, request):
+        self.sessions.pop(self.session(request).id).close()
+        return {}
+
+    def dispatch(self, connection, request):
+        command = self.COMMANDS.get(request.get('cmd'))
+        if command is None:
+            raise ValueError('Unknown command: %s' % request.get('cmd'))
+        return command(connection, request)
+
+    async def handle(self, reader, writer):
+        connection = Connection(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = {}
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        request = {}
+                        raise ValueError('Requests must be JSON objects')
+                    response = self.dispatch(connection, request)
+                except Exception as e:
+                    response = {'error': '%s: %s' % (type(e).__name__, e)}
+                response['id'] = request.get('id')
+                connection.send(response)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for session in list(self.sessions.values()):
+                session.subscribers.discard(connection)
+                if session.owner is connection:
+                    self.sessions.pop(session.id).close()
+            writer.close()
+
+    # Replaces the socket left at path by a previous server, but no other
+    # kind of file
+    async def serve(self, path):
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError('Not a socket: %s' % path)
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self.handle, path)
+        async with server:
+            await server.serve_forever()
+
+
+# Viewer of a server session in the terminal, displayed by UI. Key presses
+# are sent as press events, and releases once UI considers the key released
+async def client(stdscr, args):
+    reader, writer = await asyncio.open_unix_connection(args.socket)
+    next_id = 0
+
+    async def request(**message):
+        nonlocal next_id
+        next_id += 1
+        message['id'] = next_id
+        writer.write(json.dumps(message).encode() + b'\n')
+        while True:
+            response = json.loads(await reader.readline())
+            if response.get('id') == next_id:
+                break
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    sid = args.session
+    if sid is None:
+        sid = (await request(cmd='create', ips=args.ips,
+            frequency=args.frequency, seed=args.seed))['session']
+    if args.rom:
+        with open(args.rom, 'rb') as fin:
+            await request(cmd='load', session=sid,
+                    data=base64.b64encode(fin.read()).decode())
+    await request(cmd='subscribe', session=sid)
+
+    ui = UI(stdscr, key_timeout=args.key_timeout)
+    framebuffer = bytearray(256)
+    # Set when the UI dropped the last frame, to display it again later, as
+    # CPU.frame_pending
+    pending = False
+
+    async def receive():
+        nonlocal pending
+        while True:
+            line = await reader.readline()
+            if not line:
+                return 'Connection closed'
+            message = json.loads(line)
+            if message.get('event') == 'error':
+                return message['error']
+            if message.get('event') == 'frame':
+                for y, row in message['rows'].items():
+                    framebuffer[int(y) * 8:int(y) * 8 + 8] \
+                            = bytes.fromhex(row)
+                pending = not ui.display_framebuffer(framebuffer)
+
+    receiver = asyncio.get_running_loop().create_task(receive())
+    keys = bytearray(16)
+    while not receiver.done():
+        pressed = bytearray(16)
+        ui.read_keys(pressed)
+        for key in range(0, 16):
+            if pressed[key] != keys[key]:
+                writer.write(json.dumps({'cmd': 'key', 'session': sid,
+                    'key': key, 'pressed': bool(pressed[key])}).encode()
+                    + b'\n')
+        keys = pressed
+        if pending:
+            pending = not ui.display_framebuffer(framebuffer)
+        if ui.get_key() == 27:
+            break
+        await asyncio.sleep(1 / 60)
+    receiver.cancel()
+    writer.close()
+    return receiver.result() if receiver.done() \
+            and not receiver.cancelled() else None
+
+
+def serve_main(argv):
+    argp = argparse.ArgumentParser(description='Chip8 emulator server',
+            prog='chippy8 serve')
+    argp.add_argument("-S", "--socket", default=DEFAULT_SOCKET,
+            help="Unix socket path (default %s)" % DEFAULT_SOCKET)
+    argp.add_argument("--max-ips", type=int, default=100000,
+            help="Maximum instructions per second of a session (default "
+            "100000)")
+    argp.add_argument("--max-sessions", type=int, default=1000,
+            help="Maximum number of sessions (default 1000)")
+    argp.add_argument("--rom-dir", default=None,
+            help="Directory of the roms clients may load by path (default: "
+            "none, roms are sent as data)")
+    args = argp.parse_args(argv)
+    if args.rom_dir is not None and not os.path.isdir(args.rom_dir):
+        argp.error('Not a directory: %s' % args.rom_dir)
+    try:
+        asyncio.run(Server(args.max_ips, args.max_sessions, args.rom_dir)
+                .serve(args.socket))
+    except FileExistsError as e:
+        argp.error(str(e))
+    except KeyboardInterrupt:
+        pass
+
+
+def client_main(argv):
+    argp = argparse.ArgumentParser(description='Chip8 emulator client',
+            prog='chippy8 client')
+    argp.add_argument("rom", nargs='?', default=None,
+            help="Rom file to load in the session")
+    argp.add_argument("-S", "--socket", default=DEFAULT_SOCKET,
+            help="Unix socket path (default %s)" % DEFAULT_SOCKET)
+    argp.add_argument("--session", type=int, default=None,
+            help="View this existing session instead of creating one")
+    argp.add_argument("-f", "--frequency", type=int, default=60,
+            help="Set timers frequency (default 60Hz)")
+    argp.add_argument("-i", "--ips", type=int, default=700,
+            help="Set instructions executed per second (default 700)")
+    argp.add_argument("-s", "--seed", type=int, default=None,
+            help="Seed of the random number generator")
+    argp.add_argument("-k", "--key-timeout", type=int,
+            default=UI.KEY_TIMEOUT, help="Set the number of frames a key "
+            "stays pressed after its last key press (default %d)"
+            % UI.KEY_TIMEOUT)
+    args = argp.parse_args(argv)
+    if args.rom is None and args.session is None:
+        argp.error('a rom or --session is required')
+    import curses
+    try:
+        error = curses.wrapper(lambda stdscr: asyncio.run(client(stdscr,
+            args)))
+    except KeyboardInterrupt:
+        return 0
+    if error:
+        print(error)
+        return 1
+    return 0
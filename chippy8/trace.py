@@ -0,0 +1,175 @@
+import argparse
+import array
+import struct
+import chippy8.asm as asm
+
+# Trace files: this header, the error message, then one entry per traced
+# instruction, oldest first
+TRACE_MAGIC = b'C8TR'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('>4sBIQH')
+TRACE_ENTRY = struct.Struct('>HHBH')
+
+# Register field of the entries, besides V0 to VF
+REGISTER_I = 0x10
+REGISTER_DT = 0x11
+REGISTER_ST = 0x12
+REGISTER_NONE = 0xFF
+REGISTER_NAMES = ['V%X' % i for i in range(0, 0x10)] + ['I', 'DT', 'ST']
+
+F_REGISTERS = {
+    0x15: REGISTER_DT,
+    0x18: REGISTER_ST,
+    0x1E: REGISTER_I,
+    0x29: REGISTER_I,
+}
+
+
+# Returns the register written by an opcode, VF for draws, Vx for the flag
+# setting ALU instructions
+def written_register(opcode):
+    kind = opcode >> 12
+    x = (opcode & 0x0F00) >> 8
+    if kind in (0x6, 0x7, 0x8, 0xC):
+        return x
+    if kind == 0xD:
+        return 0xF
+    if kind == 0xA:
+        return REGISTER_I
+    if kind == 0xF:
+        sub = opcode & 0x00FF
+        if sub in (0x07, 0x0A, 0x65):
+            return x
+        return F_REGISTERS.get(sub, REGISTER_NONE)
+    return REGISTER_NONE
+
+
+def register_value(cpu, register):
+    if register < 0x10:
+        return cpu.V[register]
+    if register == REGISTER_I:
+        return cpu.I & 0xFFFF
+    if register == REGISTER_DT:
+        return cpu.DT
+    return cpu.ST
+
+
+# Records the last size instructions executed by a CPU (PC, opcode, written
+# register and its new value) in preallocated arrays used as a ring buffer.
+# Attaching a tracer makes CPU.run single step through Tracer.run instead of
+# the block engine. An error raised by an instruction is recorded with it
+class Tracer:
+    def __init__(self, cpu, size=65536):
+        self.cpu = cpu
+        self.size = size
+        self.pcs = array.array('H', bytes(2 * size))
+        self.opcodes = array.array('H', bytes(2 * size))
+        self.registers = array.array('B', bytes(size))
+        self.values = array.array('H', bytes(2 * size))
+        self.index = 0
+        # Number of instructions traced, and cycle count of the first one
+        self.recorded = 0
+        self.first_cycle = None
+        self.error = None
+        self.written = {}
+        cpu.tracer = self
+
+    def run(self, max_cycles):
+        cpu = self.cpu
+        pcs = self.pcs
+        opcodes = self.opcodes
+        registers = self.registers
+        values = self.values
+        written = self.written
+        size = self.size
+        index = self.index
+        if self.first_cycle is None:
+            self.first_cycle = cpu.cycles
+        start = cpu.cycles
+        end = cpu.cycles + max_cycles
+        try:
+            while cpu.cycles < end and not cpu.waiting:
+                pcs[index] = cpu.PC & 0xFFFF
+                cpu.step()
+                opcode = opcodes[index] = cpu.opcode
+                register = written.get(opcode)
+                if register is None:
+                    register = written[opcode] = written_register(opcode)
+                registers[index] = register
+                if register != REGISTER_NONE:
+                    values[index] = register_value(cpu, register)
+                index += 1
+                if index == size:
+                    index = 0
+        except Exception as e:
+            opcodes[index] = cpu.opcode
+            registers[index] = REGISTER_NONE
+            index = (index + 1) % size
+            self.recorded += 1
+            self.error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            self.index = index
+            self.recorded += cpu.cycles - start
+
+    # Returns the traced entries, oldest first
+    def entries(self):
+        count = min(self.recorded, self.size)
+        start = (self.index - count) % self.size
+        return [(self.pcs[i], self.opcodes[i], self.registers[i],
+            self.values[i]) for i in ((start + k) % self.size
+                for k in range(0, count))]
+
+    def pack(self):
+        entries = self.entries()
+        error = (self.error or '').encode()[:0xFFFF]
+        first_cycle = (self.first_cycle or 0) + self.recorded - len(entries)
+        return TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, len(entries),
+                first_cycle, len(error)) + error \
+                + b''.join(TRACE_ENTRY.pack(*entry) for entry in entries)
+
+    def save(self, path):
+        with open(path, 'wb') as fout:
+            fout.write(self.pack())
+
+
+# Returns (first_cycle, error, entries) from a trace file content
+def unpack_trace(blob):
+    magic, version, count, first_cycle, error_length \
+            = TRACE_HEADER.unpack_from(blob)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        raise ValueError('Unsupported trace format')
+    offset = TRACE_HEADER.size + error_length
+    error = blob[TRACE_HEADER.size:offset].decode() or None
+    entries = [TRACE_ENTRY.unpack_from(blob, offset + i * TRACE_ENTRY.size)
+            for i in range(0, count)]
+    return first_cycle, error, entries
+
+
+# Yields the lines of a decoded trace
+def format_trace(first_cycle, error, entries):
+    for i, (pc, opcode, register, value) in enumerate(entries):
+        asm_str = asm.lookup_asm(opcode) or 'invalid'
+        line = '%10d  0x%03X  %04X  %-18s' % (first_cycle + i, pc, opcode,
+                asm_str)
+        if register != REGISTER_NONE:
+            line += ' %s = 0x%X' % (REGISTER_NAMES[register], value)
+        yield line.rstrip() + '\n'
+    if error is not None:
+        yield 'error: %s\n' % error
+
+
+def main(argv):
+    argp = argparse.ArgumentParser(description='Chip8 trace decoder',
+            prog='chippy8 trace')
+    argp.add_argument("trace", help="Trace file written by the emulator")
+    argp.add_argument("-n", "--last", type=int, default=None,
+            help="Only print the last N instructions")
+    args = argp.parse_args(argv)
+    with open(args.trace, 'rb') as fin:
+        first_cycle, error, entries = unpack_trace(fin.read())
+    if args.last is not None and args.last < len(entries):
+        first_cycle += len(entries) - args.last
+        entries = entries[len(entries) - args.last:]
+    for line in format_trace(first_cycle, error, entries):
+        print(line, end='')
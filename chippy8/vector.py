@@ -0,0 +1,240 @@
+import random
+import numpy as np
+from chippy8.emulator import CPU
+
+
+# N machines stepped in lockstep, their states held as numpy arrays. Each step
+# groups the machines by opcode class and applies the instruction semantics of
+# the scalar CPU handlers as masked array operations.
+#
+# Differences with CPU: the call stack is limited to STACK_DEPTH entries, FX0A
+# returns the lowest pressed key without waiting for a new key press, and a
+# machine that would raise in CPU (stack underflow, memory access out of
+# range, invalid opcode) is halted instead, with halted[i] set.
+class VectorCPU:
+    STACK_DEPTH = 16
+
+    def __init__(self, n, seeds=None):
+        self.n = n
+        self.seeds = seeds if seeds is not None else [None] * n
+        self.reset()
+
+    def reset(self):
+        n = self.n
+        self.memory = np.zeros((n, 0x1000), np.uint8)
+        self.memory[:] = np.frombuffer(CPU().memory, np.uint8)
+        self.V = np.zeros((n, 16), np.uint8)
+        self.I = np.zeros(n, np.int64)
+        self.PC = np.full(n, 0x200, np.int64)
+        self.DT = np.zeros(n, np.int64)
+        self.ST = np.zeros(n, np.int64)
+        self.stack = np.zeros((n, self.STACK_DEPTH), np.int64)
+        self.SP = np.zeros(n, np.int64)
+        self.keys = np.zeros((n, 16), np.uint8)
+        self.halted = np.zeros(n, bool)
+        self.random = [random.Random(seed) for seed in self.seeds]
+        self.cycles = 0
+
+    # Loads a rom into all machines, or into the machines selected by index
+    def load_rom(self, program_file, machines=slice(None)):
+        with open(program_file, 'rb') as fin:
+            rom = np.frombuffer(fin.read(0x1000 - 0x200), np.uint8)
+        self.memory[machines, 0x200:0x200 + len(rom)] = rom
+
+    def tick(self):
+        self.DT = np.maximum(self.DT - 1, 0)
+        self.ST = np.maximum(self.ST - 1, 0)
+
+    # Runs cycles lockstep steps, then ticks the timers
+    def run_frame(self, cycles):
+        for _ in range(cycles):
+            self.step()
+        self.tick()
+
+    def step(self):
+        rows = np.nonzero(~self.halted)[0]
+        pc = self.PC[rows]
+        opcode = (self.memory[rows, pc & 0xFFF].astype(np.int64) << 8) \
+                | self.memory[rows, (pc + 1) & 0xFFF]
+        self.PC[rows] = pc + 2
+        kind = opcode >> 12
+        for k in np.unique(kind):
+            sel = kind == k
+            self.HANDLERS[k](self, rows[sel], opcode[sel])
+        self.cycles += 1
+
+    def halt(self, rows, mask):
+        self.halted[rows[mask]] = True
+
+    # 0x0000
+    def op_0(self, rows, opcode):
+        clear = rows[opcode == 0x00E0]
+        self.memory[clear, 0xF00:] = 0
+        ret = opcode == 0x00EE
+        self.halt(rows, ret & (self.SP[rows] == 0))
+        ret = rows[ret & (self.SP[rows] > 0)]
+        self.SP[ret] -= 1
+        self.PC[ret] = self.stack[ret, self.SP[ret]]
+
+    # 0x1000
+    def op_1(self, rows, opcode):
+        self.PC[rows] = opcode & 0x0FFF
+
+    # 0x2000
+    def op_2(self, rows, opcode):
+        full = self.SP[rows] >= self.STACK_DEPTH
+        self.halt(rows, full)
+        rows = rows[~full]
+        self.stack[rows, self.SP[rows]] = self.PC[rows]
+        self.SP[rows] += 1
+        self.PC[rows] = opcode[~full] & 0x0FFF
+
+    # 0x3000, 0x4000, 0x5000, 0x9000
+    def op_skip(self, rows, opcode):
+        vx = self.V[rows, (opcode & 0x0F00) >> 8]
+        vy = self.V[rows, (opcode & 0x00F0) >> 4]
+        nn = opcode & 0x00FF
+        kind = opcode >> 12
+        skip = ((kind == 0x3) & (vx == nn)) | ((kind == 0x4) & (vx != nn)) \
+                | ((kind == 0x5) & (vx == vy)) | ((kind == 0x9) & (vx != vy))
+        self.PC[rows[skip]] += 2
+
+    # 0x6000
+    def op_6(self, rows, opcode):
+        self.V[rows, (opcode & 0x0F00) >> 8] = opcode & 0x00FF
+
+    # 0x7000
+    def op_7(self, rows, opcode):
+        x = (opcode & 0x0F00) >> 8
+        self.V[rows, x] = (self.V[rows, x] + (opcode & 0x00FF)) & 0xFF
+
+    # 0x8000. Flag setting instructions write VF first for SUB, SHR, SUBN and
+    # SHL, the result then being computed from the updated registers, and
+    # last for ADD, as the scalar handlers do
+    def op_8(self, rows, opcode):
+        x = (opcode & 0x0F00) >> 8
+        y = (opcode & 0x00F0) >> 4
+        sub = opcode & 0x000F
+        vx = self.V[rows, x].astype(np.int64)
+        vy = self.V[rows, y].astype(np.int64)
+        self.halt(rows, ~np.isin(sub, [0x0, 0x1, 0x2, 0x3, 0x4, 0x5, 0x6,
+            0x7, 0xE]))
+
+        flag = np.select([sub == 0x5, sub == 0x6, sub == 0x7, sub == 0xE],
+                [vx > vy, vx & 0x1, vy > vx, (vx >> 7) & 0x1], 0)
+        flag_first = np.isin(sub, [0x5, 0x6, 0x7, 0xE])
+        vx = np.where(flag_first & (x == 0xF), flag, vx)
+        vy = np.where(flag_first & (y == 0xF), flag, vy)
+        total = vx + vy
+        result = np.select([sub == 0x0, sub == 0x1, sub == 0x2, sub == 0x3,
+            sub == 0x4, sub == 0x5, sub == 0x6, sub == 0x7, sub == 0xE],
+            [vy, vx | vy, vx & vy, vx ^ vy, total, vx - vy, vx >> 1,
+                vy - vx, vx << 1], vx) & 0xFF
+
+        first = flag_first & ~self.halted[rows]
+        self.V[rows[first], 0xF] = flag[first]
+        valid = ~self.halted[rows]
+        self.V[rows[valid], x[valid]] = result[valid]
+        add = (sub == 0x4) & valid
+        self.V[rows[add], 0xF] = total[add] > 0xFF
+
+    # 0xA000
+    def op_a(self, rows, opcode):
+        self.I[rows] = opcode & 0x0FFF
+
+    # 0xB000
+    def op_b(self, rows, opcode):
+        self.PC[rows] = (opcode & 0x0FFF) + self.V[rows, 0]
+
+    # 0xC000, drawn from each machine's own random.Random, as CPU.tc_rand
+    def op_c(self, rows, opcode):
+        for row, op in zip(rows, opcode):
+            self.V[row, (op & 0x0F00) >> 8] = \
+                    self.random[row].randrange(0, 255) & op & 0x00FF
+
+    # 0xD000. Each sprite row is rotated into a 64 bits word, XORed into the
+    # framebuffer row and checked for collisions, for all machines at once
+    def op_d(self, rows, opcode):
+        x = (self.V[rows, (opcode & 0x0F00) >> 8] % 64).astype(np.uint64)
+        y = self.V[rows, (opcode & 0x00F0) >> 4].astype(np.int64)
+        n = opcode & 0x000F
+        self.halt(rows, self.I[rows] + n > 0x1000)
+        valid = ~self.halted[rows]
+        rows, x, y, n = rows[valid], x[valid], y[valid], n[valid]
+        collision = np.zeros(len(rows), bool)
+        bits = np.arange(56, -8, -8, dtype=np.uint64)
+        for k in range(0, 15):
+            active = n > k
+            if not active.any():
+                break
+            r = rows[active]
+            xk = x[active]
+            sprite = self.memory[r, self.I[r] + k].astype(np.uint64) \
+                    << np.uint64(56)
+            sprite = (sprite >> xk) | (sprite << ((np.uint64(64) - xk)
+                % np.uint64(64)))
+            address = 0xF00 + ((y[active] + k) % 32) * 8
+            columns = address[:, None] + np.arange(8)
+            row = self.memory[r[:, None], columns]
+            sprite = ((sprite[:, None] >> bits) & np.uint64(0xFF)) \
+                    .astype(np.uint8)
+            collision[active] |= (row & sprite).any(axis=1)
+            self.memory[r[:, None], columns] = row ^ sprite
+        self.V[rows, 0xF] = collision
+
+    # 0xE000
+    def op_e(self, rows, opcode):
+        sub = opcode & 0x00FF
+        self.halt(rows, (sub != 0x9E) & (sub != 0xA1))
+        key = self.V[rows, (opcode & 0x0F00) >> 8].astype(np.int64)
+        pressed = np.zeros(len(rows), bool)
+        valid = key < 0x10
+        pressed[valid] = self.keys[rows[valid], key[valid]] != 0
+        skip = ((sub == 0x9E) & pressed) | ((sub == 0xA1) & ~pressed)
+        self.PC[rows[skip & ~self.halted[rows]]] += 2
+
+    # 0xF000
+    def op_f(self, rows, opcode):
+        x = (opcode & 0x0F00) >> 8
+        sub = opcode & 0x00FF
+        self.halt(rows, ~np.isin(sub, [0x07, 0x0A, 0x15, 0x18, 0x1E, 0x29,
+            0x33, 0x55, 0x65]))
+        self.halt(rows, np.isin(sub, [0x55, 0x65]) & (self.I[rows] + x
+            >= 0x1000))
+        self.halt(rows, (sub == 0x33) & (self.I[rows] + 2 >= 0x1000))
+        valid = ~self.halted[rows]
+        rows, x, sub = rows[valid], x[valid], sub[valid]
+        vx = self.V[rows, x].astype(np.int64)
+
+        sel = sub == 0x07
+        self.V[rows[sel], x[sel]] = self.DT[rows[sel]]
+        sel = sub == 0x0A
+        pressed = self.keys[rows[sel]] != 0
+        found = pressed.any(axis=1)
+        wait = rows[sel][~found]
+        self.PC[wait] -= 2
+        self.V[rows[sel][found], x[sel][found]] = \
+                pressed[found].argmax(axis=1)
+        sel = sub == 0x15
+        self.DT[rows[sel]] = vx[sel]
+        sel = sub == 0x18
+        self.ST[rows[sel]] = vx[sel]
+        sel = sub == 0x1E
+        self.I[rows[sel]] = (self.I[rows[sel]] + vx[sel]) & 0xFFFF
+        sel = sub == 0x29
+        self.I[rows[sel]] = vx[sel] * 5
+        sel = sub == 0x33
+        i = self.I[rows[sel]]
+        self.memory[rows[sel], i] = vx[sel] // 100
+        self.memory[rows[sel], i + 1] = (vx[sel] % 100) // 10
+        self.memory[rows[sel], i + 2] = vx[sel] % 10
+        for r in range(0, 16):
+            sel = (sub == 0x55) & (x >= r)
+            self.memory[rows[sel], self.I[rows[sel]] + r] = \
+                    self.V[rows[sel], r]
+            sel = (sub == 0x65) & (x >= r)
+            self.V[rows[sel], r] = self.memory[rows[sel],
+                    self.I[rows[sel]] + r]
+
+    HANDLERS = [op_0, op_1, op_2, op_skip, op_skip, op_skip, op_6, op_7,
+            op_8, op_skip, op_a, op_b, op_c, op_d, op_e, op_f]
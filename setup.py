@@ -9,9 +9,9 @@ setup(name='chippy8',
       author_email='max@23.tf',
       packages=['chippy8'],
       zip_safe = True,
-      install_requires=[
-          'parse',
-          ],
+      extras_require={
+          'vector': ['numpy'],
+          },
       entry_points={
           'console_scripts': [
               "chippy8 = chippy8.__main__:main",